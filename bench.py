@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+"""
+Measure builder's own overhead offline.
+
+The deploy paths are run against in-process fakes of EC2, ELB, AutoScale,
+S3, CloudFront and ssh that add a fixed latency to every call, and the
+wall time, API calls and ssh round trips of each are reported.  The fakes
+answer with objects boto parses from response XML, so builder reads them
+as it would read AWS.
+
+	python bench.py -n 1,10,100 -F 10000 build update s3bucket
+"""
+import binascii, collections, hashlib, json, optparse, os, os.path, shutil, StringIO, sys, tempfile, threading, time, xml.sax
+from xml.sax.saxutils import escape
+
+import boto, boto.handler, paramiko
+from boto.resultset import ResultSet
+from boto.ec2.instance import Group, Reservation
+from boto.ec2.autoscale import AutoScalingGroup, LaunchConfiguration, Trigger
+import builder
+
+scenarios = ['build', 'update', 'reconcile', 's3bucket', 'map']
+roles     = ['web', 'worker', 'cron']
+
+class Calls(object):
+	""" Count the calls made to each fake service and make them take latency[service] seconds """
+	def __init__(self, latency):
+		self.latency = latency
+		self.counts  = collections.defaultdict(int)
+		self.lock    = threading.Lock()
+
+	def __call__(self, service, action):
+		with self.lock: self.counts[service, action] += 1
+		time.sleep(self.latency.get(service, 0))
+
+	def total(self, service, actions=None):
+		return sum(n for (s, a), n in self.counts.items()
+			if s == service and (actions is None or a in actions))
+
+class Fake(object):
+	def __init__(self, **attrs): self.__dict__.update(attrs)
+
+def parse(cls, connection=None, marker='member', **elements):
+	""" Return what boto makes of a response element holding elements, so fakes answer as AWS does """
+	def value(v):
+		if isinstance(v, list): return ''.join('<member>%s</member>' % escape(str(m)) for m in v)
+		return escape(str(v))
+	body = ''.join('<%s>%s</%s>' % (name, value(v), name) for name, v in elements.items() if v is not None)
+	result = ResultSet([(marker, cls)])
+	xml.sax.parseString('<Response><%s>%s</%s></Response>' % (marker, body, marker),
+		boto.handler.XmlHandler(result, connection))
+	return result[0]
+
+class FakeInstance(object):
+	def __init__(self, ec2, id, image_id, name=None, dns_name=None):
+		self.id, self.image_id, self.ec2 = id, image_id, ec2
+		self.public_dns_name = dns_name or '%s.compute.example' % id
+		self.launched = time.time()
+		self.state, self.reason, self.tags = 'pending', '', name and {'Name':name} or {}
+
+	def copy(self):
+		i = FakeInstance(self.ec2, self.id, self.image_id, dns_name=self.public_dns_name)
+		i.tags, i.launched = self.tags, self.launched
+		i.state = time.time() - self.launched >= self.ec2.boot and 'running' or 'pending'
+		return i
+
+	def _update(self, other):
+		self.__dict__.update(other.__dict__)
+
+	def terminate(self):
+		self.ec2.calls('ec2', 'TerminateInstances')
+
+class FakeEC2(object):
+	""" EC2 whose instances run once they are boot seconds old and whose images are available at once """
+	def __init__(self, calls, boot=0):
+		self.calls, self.boot = calls, boot
+		self.access_key, self.secret_key = 'bench', 'bench'
+		self.instances, self.images = {}, set()
+		self.lock = threading.Lock()
+
+	def add(self, image_id, name=None, dns_name=None):
+		with self.lock:
+			i = FakeInstance(self, 'i-%08x' % len(self.instances), image_id, name, dns_name)
+			self.instances[i.id] = i
+		return i
+
+	def run_instances(self, image_id, min_count=1, max_count=1, **kwargs):
+		self.calls('ec2', 'RunInstances')
+		return self.reservation([self.add(image_id) for n in range(max_count)])
+
+	def reservation(self, instances):
+		""" Wrap instances the way boto does, with their security groups on the reservation """
+		reservation = Reservation(self)
+		reservation.groups = [parse(Group, marker='item', groupId='default')]
+		reservation.instances = instances
+		return reservation
+
+	def create_tags(self, ids, tags):
+		self.calls('ec2', 'CreateTags')
+		for id in ids: self.instances[id].tags.update(tags)
+
+	def get_all_instances(self, instance_ids=None, filters=None):
+		self.calls('ec2', 'DescribeInstances')
+		with self.lock: instances = self.instances.values()
+		if instance_ids: instances = [i for i in instances if i.id in instance_ids]
+		if filters and 'dns-name' in filters:
+			instances = [i for i in instances if i.public_dns_name == filters['dns-name']]
+		return [self.reservation([i.copy() for i in instances])]
+
+	def create_image(self, instance_id, name, description=None, no_reboot=False):
+		self.calls('ec2', 'CreateImage')
+		with self.lock:
+			image = 'ami-%08x' % (len(self.images) + 1)
+			self.images.add(image)
+		return image
+
+	def get_all_images(self, image_ids=None, **kwargs):
+		self.calls('ec2', 'DescribeImages')
+		return [Fake(id=i, state='available', block_device_mapping={})
+			for i in image_ids or self.images if i in self.images]
+
+	def get_all_key_pairs(self):
+		self.calls('ec2', 'DescribeKeyPairs')
+		return [Fake(name='bench', fingerprint='00:00')]
+
+	def get_all_security_groups(self):
+		self.calls('ec2', 'DescribeSecurityGroups')
+		return [Fake(name='default', rules=[])]
+
+class FakeELB(object):
+	def __init__(self, calls):
+		self.calls, self.lbs = calls, {}
+
+	def get_all_load_balancers(self, load_balancer_names=None):
+		self.calls('elb', 'DescribeLoadBalancers')
+		return self.lbs.values()
+
+	def create_load_balancer(self, name, zones, listeners):
+		self.calls('elb', 'CreateLoadBalancer')
+		lb = Fake(name=name, dns_name='%s.elb.example' % name, health_check=None, instances=[])
+		lb.configure_health_check = lambda hc: self.configure_health_check(name, hc)
+		self.lbs[name] = lb
+		return lb
+
+	def configure_health_check(self, name, hc):
+		self.calls('elb', 'ConfigureHealthCheck')
+		self.lbs[name].health_check = hc
+
+class FakeAutoScale(object):
+	def __init__(self, calls):
+		self.calls, self.configs, self.groups, self.triggers = calls, {}, {}, {}
+
+	def get_all_launch_configurations(self, names=None):
+		self.calls('autoscale', 'DescribeLaunchConfigurations')
+		return [self.configs[n] for n in names or self.configs if n in self.configs]
+
+	def get_all_groups(self, names=None):
+		self.calls('autoscale', 'DescribeAutoScalingGroups')
+		return [self.groups[n] for n in names or self.groups if n in self.groups]
+
+	def get_all_triggers(self, group):
+		self.calls('autoscale', 'DescribeTriggers')
+		return self.triggers.get(group, {}).values()
+
+	def create_launch_configuration(self, lc):
+		self.calls('autoscale', 'CreateLaunchConfiguration')
+		self.configs[lc.name] = parse(LaunchConfiguration, self, LaunchConfigurationName=lc.name,
+			ImageId=lc.image_id, KeyName=lc.key_name, InstanceType=lc.instance_type,
+			SecurityGroups=list(lc.security_groups))
+
+	def create_auto_scaling_group(self, ag):
+		return self._update_group('CreateAutoScalingGroup', ag)
+
+	def _update_group(self, op, ag):
+		""" What boto's AutoScalingGroup.update() calls """
+		self.calls('autoscale', op)
+		self.groups[ag.name] = parse(AutoScalingGroup, self, AutoScalingGroupName=ag.name,
+			LaunchConfigurationName=ag.launch_config_name, MinSize=ag.min_size,
+			MaxSize=ag.max_size, Cooldown=ag.cooldown)
+
+	def create_trigger(self, trigger):
+		self.calls('autoscale', 'CreateOrUpdateScalingTrigger')
+		self.triggers.setdefault(trigger.autoscale_group.name, {})[trigger.name] = parse(Trigger, self,
+			TriggerName=trigger.name, AutoScalingGroupName=trigger.autoscale_group.name,
+			MeasureName=trigger.measure_name, Statistic=trigger.statistic, Unit=trigger.unit,
+			Period=trigger.period, BreachDuration=trigger.breach_duration,
+			LowerThreshold=trigger.lower_threshold, UpperThreshold=trigger.upper_threshold,
+			LowerBreachScaleIncrement=trigger.lower_breach_scale_increment,
+			UpperBreachScaleIncrement=trigger.upper_breach_scale_increment)
+
+class FakeBucket(object):
+	def __init__(self, s3, name):
+		self.s3, self.name, self.keys = s3, name, {}
+		self.parts = {} # upload id -> {part number: (size, md5)}
+
+	def new_key(self, name):
+		return FakeKey(self, name)
+
+	def initiate_multipart_upload(self, name, headers=None):
+		self.s3.calls('s3', 'CreateMultipartUpload')
+		upload = FakeMultiPartUpload(self, name, 'upload-%s' % len(self.parts))
+		self.parts[upload.id] = {}
+		return upload
+
+	def complete_multipart_upload(self, name, id, xml):
+		""" Join the parts into a key whose ETag is made the way S3 makes it """
+		self.s3.calls('s3', 'CompleteMultipartUpload')
+		parts = [part for n, part in sorted(self.parts.pop(id).items())]
+		key = FakeKey(self, name)
+		key.size = sum(size for size, md5 in parts)
+		key.etag = '"%s-%s"' % (hashlib.md5(''.join(binascii.unhexlify(md5)
+			for size, md5 in parts)).hexdigest(), len(parts))
+		self.keys[name] = key
+		return Fake(etag=key.etag)
+
+	def list(self):
+		keys = self.keys.values()
+		for n in range(0, len(keys) or 1, 1000):
+			self.s3.calls('s3', 'ListObjects')
+		return keys
+
+	def delete_key(self, name):
+		self.s3.calls('s3', 'DeleteObject')
+		self.keys.pop(name, None)
+
+	def set_acl(self, acl):
+		self.s3.calls('s3', 'PutBucketAcl')
+
+class FakeS3(object):
+	def __init__(self, calls):
+		self.calls, self.buckets = calls, {}
+
+	def get_bucket(self, name, validate=True):
+		if validate:
+			self.calls('s3', 'ListObjects')
+			if name not in self.buckets: raise boto.exception.S3ResponseError(404, 'NoSuchBucket')
+		return self.buckets.setdefault(name, FakeBucket(self, name))
+
+	def create_bucket(self, name):
+		self.calls('s3', 'CreateBucket')
+		return self.buckets.setdefault(name, FakeBucket(self, name))
+
+	def get_all_buckets(self):
+		self.calls('s3', 'ListBuckets')
+		return self.buckets.values()
+
+class FakeMultiPartUpload(object):
+	def __init__(self, bucket, name, id):
+		self.bucket, self.key_name, self.id = bucket, name, id
+
+	def to_xml(self):
+		self.bucket.s3.calls('s3', 'ListParts')
+		return '<CompleteMultipartUpload/>'
+
+	def cancel_upload(self):
+		self.bucket.s3.calls('s3', 'AbortMultipartUpload')
+		self.bucket.parts.pop(self.id, None)
+
+class FakeKey(object):
+	""" Stands in for boto's Key, storing what it is sent in a FakeBucket """
+	def __init__(self, bucket, name):
+		self.bucket, self.name = bucket, name
+
+	def set_contents_from_filename(self, filename, headers=None, policy=None, md5=None):
+		self.bucket.s3.calls('s3', 'PutObject')
+		self.size = os.path.getsize(filename)
+		self.etag = '"%s"' % (md5 and md5[0] or builder.md5file(filename))
+		self.bucket.keys[self.name] = self
+
+	def set_contents_from_file(self, fp, headers=None, replace=True, cb=None, num_cb=10,
+			policy=None, md5=None, reduced_redundancy=False, query_args=None):
+		""" Store a part sent by boto's MultiPartUpload.upload_part_from_file() """
+		self.bucket.s3.calls('s3', 'UploadPart')
+		args = dict(arg.split('=') for arg in query_args.split('&'))
+		data = fp.read()
+		self.bucket.parts[args['uploadId']][int(args['partNumber'])] = (len(data),
+			hashlib.md5(data).hexdigest())
+
+class FakeCloudFront(object):
+	def __init__(self, calls):
+		self.calls = calls
+
+	def create_invalidation_request(self, distribution, paths):
+		self.calls('cloudfront', 'CreateInvalidation')
+
+class FakeChannel(object):
+	""" An ssh session on which every command succeeds with no output """
+	pipe = os.pipe()
+
+	def __init__(self, calls):
+		self.calls, self.out = calls, ''
+
+	def exec_command(self, command):
+		self.calls('ssh', 'exec')
+
+	def invoke_subsystem(self, name):
+		self.calls('ssh', name)
+
+	def fileno(self): return self.pipe[0]
+	def recv_ready(self): return False
+	def recv_stderr_ready(self): return False
+	def exit_status_ready(self): return True
+	def recv_exit_status(self): return 0
+	def sendall(self, data): pass
+	def shutdown_write(self): pass
+	def makefile_stderr(self, mode, size): return StringIO.StringIO('')
+	def close(self): pass
+
+class FakeSFTP(object):
+	def __init__(self, channel): pass
+	def open(self, filename, mode): return StringIO.StringIO()
+
+def fake(calls, boot):
+	""" Point builder at fresh fakes and return the fake EC2 connection """
+	ec2, elb, asg = FakeEC2(calls, boot), FakeELB(calls), FakeAutoScale(calls)
+	s3, cloudfront = FakeS3(calls), FakeCloudFront(calls)
+	boto.connect_elb       = lambda *args, **kwargs: elb
+	boto.connect_autoscale = lambda *args, **kwargs: asg
+	boto.connect_s3        = lambda *args, **kwargs: s3
+	builder.CloudFrontConnection = lambda *args, **kwargs: cloudfront
+	builder.Key = FakeKey
+	paramiko.SFTPClient = FakeSFTP
+	def connect(pool, host, key, user):
+		calls('ssh', 'connect')
+		transport = Fake(is_active=lambda: True, open_session=lambda: FakeChannel(calls))
+		return Fake(close=lambda: None, get_transport=lambda: transport)
+	builder.SSHPool.connect = connect
+	def probe(address, timeout=None):
+		calls('ssh', 'probe')
+		return Fake(close=lambda: None)
+	builder.socket.create_connection = probe
+	return ec2
+
+def make_source(directory, files, large=0):
+	"""
+	Write a source tree with deploy files for each role, files small static
+	files and large static files of 20MB, which s3bucket sends in parts.
+	"""
+	source = os.path.join(directory, 'source')
+	deploy = os.path.join(source, 'deploy')
+	for role in roles:
+		etc = os.path.join(deploy, role, 'etc', role)
+		os.makedirs(etc)
+		for n in range(5): open(os.path.join(etc, '%s.conf' % n), 'w').write('%s %s\n' % (role, n))
+	key = os.path.join(deploy, 'bench.pem')
+	open(key, 'w').write('key')
+	os.chmod(key, 0600)
+	static = os.path.join(source, 'project', 'static')
+	for n in range(files):
+		d = os.path.join(static, 'd%02d' % (n % 100))
+		if not os.path.isdir(d): os.makedirs(d)
+		open(os.path.join(d, 'f%05d.%s' % (n, ('css', 'js', 'png')[n % 3])), 'w').write('%s\n' % n * 32)
+	for n in range(large):
+		if not os.path.isdir(static): os.makedirs(static)
+		with open(os.path.join(static, 'large%02d.bin' % n), 'wb') as f:
+			f.write('%s\n' % n)
+			f.truncate(20 << 20)
+	return source
+
+def make_env(machines, ec2=None):
+	""" Return a deploy env of machines cycling through roles, registered with ec2 if given """
+	env = []
+	for n in range(machines):
+		role = roles[n % len(roles)]
+		machine = {'name':role, 'base':'ami-base', 'size':'m1.small', 'groups':['default'],
+			'key_pair':'bench', 'init':['apt-get -y install %s-%s' % (role, i) for i in range(5)],
+			'update':['sudo service %s restart' % role], 'image':'ami-%s' % role}
+		if n < len(roles):
+			machine['load_balancer'] = {'name':'%s-lb' % role}
+			machine['autoscale'] = {'min_size':'1', 'max_size':'4'}
+		if ec2: machine['host'] = ec2.add('ami-base', role).public_dns_name
+		env.append(machine)
+	return env
+
+def run(scenario, machines, source, ec2, options):
+	""" Run scenario against the fakes and return its wall time """
+	if scenario == 'build':
+		env = make_env(machines)
+		started = time.time()
+		builder.build(ec2, env, source, jobs=options.jobs, script=options.script, poll=options.poll)
+	elif scenario == 'update':
+		env = make_env(machines, ec2)
+		started = time.time() # rsync needs a real host, so push an artifact
+		builder.update(ec2, env, source, jobs=options.jobs, artifact=True, script=options.script)
+	elif scenario == 'reconcile':
+		env = make_env(machines, ec2)
+		started = time.time()
+		builder.load_balance(ec2, env, jobs=options.jobs)
+		builder.autoscale(ec2, env, jobs=options.jobs)
+	elif scenario == 's3bucket':
+		env = [{'name':'static', 's3bucket':{'name':'bench-static'}, 'cloudfront':'E1BENCH'}]
+		started = time.time()
+		builder.s3bucket(ec2, env, source)
+	elif scenario == 'map':
+		make_env(machines, ec2)
+		started = time.time()
+		builder.get_map(ec2, refresh=True)
+	return time.time() - started
+
+def main(options, args):
+	latency = {'ec2':options.api, 'elb':options.api, 'autoscale':options.api,
+		's3':options.api, 'cloudfront':options.api, 'ssh':options.ssh}
+	sizes = [int(n) for n in options.machines.split(',')]
+	directory = tempfile.mkdtemp(prefix='builder.bench.')
+	print 'api latency %.3fs, ssh latency %.3fs, %s static files, %s of 20MB, %s jobs%s' % (options.api,
+		options.ssh, options.files, options.large, options.jobs, options.script and ', batched scripts' or '')
+	print '%-10s %8s %9s %9s %9s %9s  %s' % ('scenario', 'machines', 'wall s',
+		'api calls', 'ssh trips', 'ssh conns', 'busiest calls')
+	results = []
+	try:
+		source = make_source(directory, options.files, options.large)
+		for scenario in args or scenarios:
+			if scenario not in scenarios: sys.exit('unknown scenario %s' % scenario)
+			for machines in scenario == 's3bucket' and [0] or sizes:
+				# Fresh caches for each run, kept out of the real ~/.builder
+				os.environ['HOME'] = tempfile.mkdtemp(dir=directory)
+				calls = Calls(latency)
+				ec2 = fake(calls, options.boot)
+				for attempt in scenario == 's3bucket' and ['cold', 'warm'] or ['']:
+					calls.counts.clear()
+					stdout, sys.stdout = sys.stdout, options.verbose and sys.stdout or open(os.devnull, 'w')
+					try: wall = run(scenario, machines, source, ec2, options)
+					except SystemExit, e: wall = 'failed: %s' % e
+					finally:
+						sys.stdout = stdout
+						builder.connections.close()
+						builder.inventories.clear()
+					api = sum(n for (s, a), n in calls.counts.items() if s != 'ssh')
+					trips = calls.total('ssh', ('exec', 'sftp'))
+					busiest = sorted(((n, a) for (s, a), n in calls.counts.items()), reverse=True)[:3]
+					name = attempt and '%s %s' % (scenario, attempt) or scenario
+					print '%-10s %8s %9s %9s %9s %9s  %s' % (name, machines or '-',
+						isinstance(wall, float) and '%.3f' % wall or '-', api, trips,
+						calls.total('ssh', ('connect',)), ', '.join('%s %s' % (a, n) for n, a in busiest))
+					if not isinstance(wall, float): print '\t%s' % wall
+					results.append({'scenario':name, 'machines':machines, 'wall':wall,
+						'calls':dict(('%s:%s' % k, n) for k, n in calls.counts.items())})
+	finally:
+		shutil.rmtree(directory)
+	if options.json: json.dump(results, open(options.json, 'w'), indent=4)
+
+if __name__ == '__main__':
+	parser = optparse.OptionParser(usage='%prog [options] [scenario ...]',
+		description='scenarios: %s' % ', '.join(scenarios))
+	parser.add_option('-n', '--machines', default='1,10,100',
+		help='fleet sizes to run, comma separated [default: %default]', metavar='N,N')
+	parser.add_option('-F', '--files', default=10000, type='int',
+		help='static files for s3bucket [default: %default]', metavar='N')
+	parser.add_option('-G', '--large', default=2, type='int',
+		help='20MB static files, sent as multipart uploads [default: %default]', metavar='N')
+	parser.add_option('-A', '--api', default=0.05, type='float',
+		help='seconds each api call takes [default: %default]', metavar='SECONDS')
+	parser.add_option('-L', '--ssh', default=0.05, type='float',
+		help='seconds each ssh round trip takes [default: %default]', metavar='SECONDS')
+	parser.add_option('-b', '--boot', default=0.5, type='float',
+		help='seconds a new instance stays pending [default: %default]', metavar='SECONDS')
+	parser.add_option('-p', '--poll', default=0.1, type='float',
+		help='first instance poll delay [default: %default]', metavar='SECONDS')
+	parser.add_option('-j', '--jobs', default=4, type='int',
+		help='machines handled at once [default: %default]', metavar='N')
+	parser.add_option('-B', '--batch', action='store_true', dest='script',
+		help='run commands as one remote script',)
+	parser.add_option('-o', '--json', help='also write the results to FILE', metavar='FILE')
+	parser.add_option('-v', '--verbose', action='store_true', help='show builder\'s output')
+	main(*parser.parse_args())
@@ -1,12 +1,17 @@
 #!/usr/bin/env python
-import datetime, json, optparse, os, os.path, subprocess, sys, time, webbrowser
+import binascii, calendar, contextlib, datetime, gzip, hashlib, httplib, json, math, mimetypes
+import multiprocessing, optparse, os, os.path, pipes, posixpath, Queue, shutil, StringIO, subprocess, sys, time, webbrowser
 from stat import S_IMODE
-import BaseHTTPServer, tempfile, threading, urlparse
+import BaseHTTPServer, cgi, collections, fcntl, glob, re, select, socket, SocketServer, tempfile, threading, urlparse
 
 import boto, paramiko
 from boto.ec2.autoscale import AutoScalingGroup, LaunchConfiguration, Trigger
+from boto.ec2.instance import Instance
+from boto.s3.connection import OrdinaryCallingFormat
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
 from boto.cloudfront import CloudFrontConnection
+from boto.cloudfront.exception import CloudFrontServerError
 
 default_ami      = 'ami-1aad5273' #64-bit Ubuntu 11.04, us-east-1
 default_key_pair = 'ec2.example'
@@ -15,19 +20,150 @@ default_key_pair = 'ec2.example'
 VERSION  = '0.0.1'
 alert    = lambda s: '\033[31m%s\033[0m' % s
 path     = lambda s: '\033[36m%s\033[0m' % s
+print_lock = threading.Lock()
+context    = threading.local() # run, the build server job of this thread
+gzip_types = ['css', 'eot', 'htm', 'html', 'js', 'json', 'otf', 'svg', 'ttf',
+	'txt', 'xml']
 defaults = {'key':None, 'secret':None, 'repo':None, 'deploy':{
 	'default':[{'base':default_ami, 'size':'t1.micro', 'groups':['default'],
 		'key_pair':default_key_pair, 'name':'example', 'init':[], 'update':[],
 		'url':'/'
 	}],
 }}
+def cache_dir(*names):
+	""" Return a directory under ~/.builder, creating it if need be """
+	directory = os.path.join(os.path.expanduser('~'), '.builder', *names)
+	if not os.path.isdir(directory): os.makedirs(directory)
+	return directory
+
+def write_atomic(filename, data):
+	""" Replace filename with data so readers see either the old or the new file """
+	f = tempfile.NamedTemporaryFile(dir=os.path.dirname(filename) or '.',
+			prefix='.%s.' % os.path.basename(filename), delete=False)
+	try:
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+		f.close()
+		os.rename(f.name, filename)
+	except:
+		f.close()
+		os.remove(f.name)
+		raise
+
 def error(message):
 	""" Print error and exit """
 	sys.exit('%s %s' % (alert('\nerror:'), message))
 
 def warning(message):
 	""" Print warning """
-	print alert('warning:'), message
+	with print_lock:
+		print alert('warning:'), message
+
+def log(name, message):
+	""" Print a message prefixed with the name of the machine it concerns """
+	with print_lock:
+		print '%s %s' % (path('[%s]' % name), message)
+
+def parallel(fn, items, jobs=1):
+	"""
+	Call fn on each item from at most jobs threads.
+
+	Returns a list of (item, exception) for every call that raised, including
+	calls that aborted through error().  Workers belong to the caller's run.
+	"""
+	queue, failed = Queue.Queue(), []
+	for item in items: queue.put(item)
+	run = getattr(context, 'run', None)
+	def worker():
+		context.run = run
+		while 1:
+			try: item = queue.get_nowait()
+			except Queue.Empty: return
+			try: fn(item)
+			except (Exception, SystemExit), e:
+				failed.append((item, e))
+	threads = [threading.Thread(target=worker)
+			for n in range(max(1, min(jobs, queue.qsize())))]
+	for t in threads: t.start()
+	for t in threads: t.join()
+	return failed
+
+def summarize(done, verb, succeeded, total, failed):
+	""" Print how many of total machines succeeded, listing and aborting on failures """
+	print '%s %s of %s servers' % (done, succeeded, total)
+	if failed:
+		for name, e in failed:
+			print '\t%s\t%s' % (name, alert(e))
+		error('%s server%s failed to %s' % (len(failed), len(failed)>1 and 's' or '', verb))
+
+class Trace(object):
+	"""
+	Timed spans of a run.
+
+	Nothing is recorded until the trace is enabled.  Each span records its
+	phase, start, duration, thread and the run (build server job) it belongs
+	to, plus any attributes it was opened with, and is also written as a
+	JSON line to the file given to open().
+	"""
+	def __init__(self):
+		self.spans   = []
+		self.lock    = threading.Lock()
+		self.out     = None
+		self.enabled = False
+
+	def open(self, filename):
+		""" Record spans and append them to filename """
+		self.out, self.enabled = open(filename, 'a'), True
+
+	@contextlib.contextmanager
+	def span(self, phase, **attrs):
+		""" Time the body of the with statement as phase, yielding attrs so it can add to them """
+		if not self.enabled:
+			yield attrs
+			return
+		started = time.time()
+		try: yield attrs
+		finally:
+			attrs.update(phase=phase, start=started, duration=time.time() - started,
+				run=getattr(context, 'run', None), thread=threading.current_thread().name)
+			with self.lock:
+				self.spans.append(attrs)
+				if self.out:
+					self.out.write(json.dumps(attrs) + '\n')
+					self.out.flush()
+
+	def pop(self, run=None):
+		""" Remove and return the spans of run """
+		with self.lock:
+			spans = [span for span in self.spans if span['run'] == run]
+			self.spans = [span for span in self.spans if span['run'] != run]
+			return spans
+
+def profile(spans, n=10):
+	""" Return the time spent in each phase and the slowest remote commands """
+	phases = {}
+	for span in spans:
+		phase = phases.setdefault(span['phase'], {'count':0, 'total':0, 'max':0})
+		phase['count'] += 1
+		phase['total'] += span['duration']
+		phase['max'] = max(phase['max'], span['duration'])
+	commands = sorted((span for span in spans if 'command' in span),
+			key=lambda span: -span['duration'])[:n]
+	return {'phases':phases, 'commands':[dict((k, span.get(k)) for k in
+		('duration', 'phase', 'host', 'command')) for span in commands]}
+
+def print_profile(spans, n=10):
+	""" Print a table of the slowest phases and remote commands """
+	data = profile(spans, n)
+	print 'Phase%s Count      Total        Max' % (' ' * 15)
+	for phase, v in sorted(data['phases'].iteritems(), key=lambda p: -p[1]['total'])[:n]:
+		print '%-20s %5s %9.2fs %9.2fs' % (phase, v['count'], v['total'], v['max'])
+	if data['commands']:
+		print
+		print 'Slowest commands:'
+		for c in data['commands']:
+			print '%9.2fs  %s  %s' % (c['duration'], c['host'], c['command'])
 
 def get_key(source, name):
 	""" 
@@ -47,245 +183,1293 @@ def get_key(source, name):
 		error('key [%s] with perms %s must have 0600 or 0400, aborting' % (name,mode))
 	return key
 
-def ssh(host, key, command):
-	""" Call ssh with a host, key, and a command to run """
-	client = paramiko.SSHClient()
-	client.load_system_host_keys()
-	client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-	client.connect(host, username='ubuntu', key_filename=key) #TODO:Username?
-	i, o, e = client.exec_command(command)
-	o, e = o.read(), e.read()
-	if e: warning(e)
-	return o
+class SSHPool(object):
+	"""
+	Pool of ssh connections keyed by host, user and key file.
+
+	A connection is opened once per key and every command after that runs on
+	a new channel of the same transport.  Connections that have been unused
+	for longer than idle seconds are closed the next time the pool is used.
+	"""
+	def __init__(self, idle=300):
+		self.idle    = idle
+		self.lock    = threading.Lock()
+		self.clients = {} # (host, user, key) -> [client, last used, sessions]
+
+	def connect(self, host, key, user):
+		client = paramiko.SSHClient()
+		client.load_system_host_keys()
+		client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+		try: client.connect(host, username=user, key_filename=key)
+		except:
+			client.close() # Stop the transport thread a failed handshake leaves running
+			raise
+		return client
+
+	def checkout(self, ident):
+		""" Return the live pool entry for ident and mark it in use """
+		with self.lock:
+			entry = self.clients.get(ident)
+			if entry and not entry[0].get_transport().is_active():
+				del self.clients[ident]
+				entry[0].close()
+				entry = None
+			if entry: entry[2] += 1
+			return entry
+
+	@contextlib.contextmanager
+	def session(self, host, key, user='ubuntu'):
+		""" Yield a new channel on the pooled transport for host """
+		self.reap()
+		ident = (host, user, key)
+		entry = self.checkout(ident)
+		if not entry:
+			client = self.connect(host, key, user)
+			with self.lock:
+				if ident in self.clients: client.close() # Lost a connect race
+				else: self.clients[ident] = [client, time.time(), 0]
+			entry = self.checkout(ident)
+		try:
+			channel = entry[0].get_transport().open_session()
+			try: yield channel
+			finally: channel.close()
+		finally:
+			with self.lock:
+				entry[1] = time.time()
+				entry[2] -= 1
+
+	def reap(self):
+		""" Close connections that have been idle too long """
+		now = time.time()
+		with self.lock:
+			for ident, (client, used, sessions) in self.clients.items():
+				if not sessions and now - used > self.idle:
+					del self.clients[ident]
+					client.close()
+
+	def close(self):
+		""" Close every pooled connection """
+		with self.lock:
+			for client, used, sessions in self.clients.values():
+				client.close()
+			self.clients.clear()
+
+connections = SSHPool()
+trace       = Trace()
+
+Result = collections.namedtuple('Result', 'status out err elapsed')
+
+def execute(host, key, command, user='ubuntu', name=None, timeout=None, quiet=False):
+	"""
+	Run command on host and return its Result, printing its output a line at
+	a time as it arrives, prefixed with name.  stdout and stderr are drained
+	together so a command can't stall on a full buffer, and the command is
+	abandoned after timeout seconds.  With quiet only stderr is printed.
+	"""
+	name, started = name or host, time.time()
+	output, partial = {'out':[], 'err':[]}, {'out':'', 'err':''}
+	def show(stream, line):
+		if stream == 'err': log(name, alert(line))
+		elif not quiet: log(name, line)
+	def read(stream, data):
+		output[stream].append(data)
+		lines = (partial[stream] + data).split('\n')
+		partial[stream] = lines.pop()
+		for line in lines: show(stream, line)
+	with trace.span('ssh', host=host, command=command) as attrs:
+		with connections.session(host, key, user) as channel: #TODO:Username?
+			channel.exec_command(command)
+			while 1:
+				if timeout and time.time() - started > timeout: # Even if it keeps printing
+					error('[%s] timed out after %ss on %s' % (command, timeout, host))
+				if channel.recv_ready(): read('out', channel.recv(32768))
+				elif channel.recv_stderr_ready(): read('err', channel.recv_stderr(32768))
+				elif channel.exit_status_ready(): break
+				else: select.select([channel], [], [], 0.1)
+			status = channel.recv_exit_status()
+		for stream in partial:
+			if partial[stream]: show(stream, partial[stream])
+		attrs['status'] = status
+	return Result(status, ''.join(output['out']), ''.join(output['err']), time.time() - started)
+
+def ssh(host, key, command, user='ubuntu', name=None, timeout=None, quiet=False):
+	""" Call ssh with a host, key, and a command to run, and return its stdout """
+	result = execute(host, key, command, user, name, timeout, quiet)
+	if result.status: warning('[%s] exited with %s on %s' % (command, result.status, host))
+	return result.out
+
+def run_script(host, key, commands, user='ubuntu', name=None, timeout=None, record=None):
+	"""
+	Upload commands as one bash script over SFTP and run it in a single
+	round trip, stopping at the first step that fails.  Each step runs in a
+	subshell, as it would over its own ssh call, after printing a marker so
+	a failure can be pinned on it, and is followed by its record command if
+	it succeeds.
+	"""
+	script = ['set -e']
+	for n, command in enumerate(commands):
+		script.append('echo %s' % pipes.quote('Running step %s/%s [%s]' % (n + 1, len(commands), command)))
+		script.append('(%s)' % command)
+		if record: script.append(record[n])
+	script = '\n'.join(script) + '\n'
+	filename = '/tmp/builder-%s.sh' % hashlib.md5(script).hexdigest()
+	with trace.span('upload script', host=host):
+		with connections.session(host, key, user) as channel:
+			channel.invoke_subsystem('sftp')
+			with contextlib.closing(paramiko.SFTPClient(channel).open(filename, 'w')) as f:
+				f.write(script)
+	result = execute(host, key, 'bash %s; status=$?; rm -f %s; exit $status' % (filename, filename),
+			user, name, timeout)
+	if result.status:
+		steps = re.findall('^Running step (\d+)/', result.out, re.M)
+		error('[%s] exited with %s on %s' % (steps and commands[int(steps[-1]) - 1] or 'sh',
+			result.status, host))
+	return result
+
+def run_commands(machine, key, commands, script=False, record=None):
+	"""
+	Run commands on a machine with one ssh call each, or as one script.
+	record, if given, holds a command to run after each command succeeds.
+	"""
+	name, timeout = machine['name'], machine.get('command_timeout')
+	if script and commands:
+		return run_script(machine['host'], key, commands, name=name,
+				timeout=timeout and timeout * len(commands), record=record)
+	for n, command in enumerate(commands):
+		log(name, 'Running [%s]' % command)
+		ssh(machine['host'], key, record and '(%s) && %s' % (command, record[n]) or command,
+				name=name, timeout=timeout)
 
 #def ssh(host, key, command):
 #	subprocess.call('ssh -i %s ubuntu@%s "%s"' % (key, host, command), shell=True)
 
+path_locks, path_locks_lock = {}, threading.Lock()
+
+@contextlib.contextmanager
+def locked(filename):
+	""" Hold a lock on filename against other threads and other processes """
+	with path_locks_lock:
+		lock = path_locks.setdefault(filename, threading.Lock())
+	with lock:
+		with open(filename + '.lock', 'a') as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			try: yield
+			finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+def disk_usage(directory):
+	""" Return the size of directory in megabytes """
+	return int(subprocess.Popen(['du', '-sm', directory],
+		stdout=subprocess.PIPE).communicate()[0].split()[0])
+
+def checkout_size(checkout, measure=False):
+	""" Return the size of checkout in megabytes as recorded when it was last updated """
+	filename = checkout + '.size'
+	if measure or not os.path.exists(filename):
+		write_atomic(filename, str(disk_usage(checkout)))
+	return int(open(filename).read())
+
+def evict_checkouts(limit, keep):
+	"""
+	Remove the least recently used working copies, other than keep, until
+	the checkout cache is under limit megabytes.  Sizes are the ones
+	recorded when each copy was last updated, so only keep is measured on
+	a run.  Exports left behind by runs that died are removed after a day.
+	"""
+	for export in glob.glob(os.path.join(cache_dir('exports'), '*')):
+		if time.time() - os.path.getmtime(export) > 86400 and export not in exports:
+			shutil.rmtree(export, True)
+	directory = cache_dir('checkouts')
+	checkouts = sorted((os.path.getmtime(c + '.lock'), c)
+			for c in glob.glob(os.path.join(directory, '*')) if os.path.isdir(c))
+	usage = dict((c, checkout_size(c)) for t, c in checkouts)
+	for t, checkout in checkouts:
+		if sum(usage.values()) <= limit: break
+		if checkout == keep: continue
+		with locked(checkout):
+			print 'Evicting %s' % path(checkout)
+			shutil.rmtree(checkout, True)
+			if os.path.exists(checkout + '.size'): os.remove(checkout + '.size')
+		del usage[checkout]
+
+exports = set()
+
+def discard(source=None):
+	""" Remove an exported source tree, or every one made by this process """
+	for export in source and [source] or list(exports):
+		if export in exports:
+			exports.discard(export)
+			shutil.rmtree(export, True)
+
 def prepare(settings, dir=None, tag=None):
+	"""
+	Return the source directory to deploy from.
+
+	Repos are checked out once into a working copy cached under
+	~/.builder/checkouts by repo url, which later runs switch to the
+	requested tag so only changes are fetched, and are then exported to a
+	clean tree.  The cache is kept under the settings' checkout_cache
+	megabytes (default 10240).
+	"""
+	with trace.span('prepare', tag=tag):
+		return _prepare(settings, dir, tag)
+
+def _prepare(settings, dir, tag):
 	if dir: source = os.path.abspath(dir)
 	elif 'repo' in settings and settings['repo']:
-		source = tempfile.mkdtemp(prefix='builder.%s.' %
-				settings['repo'].split('/')[-2])
+		name = settings['repo'].split('/')[-2]
+		checkout = os.path.join(cache_dir('checkouts'), '%s.%s' % (name,
+			hashlib.md5(settings['repo']).hexdigest()[:8]))
 		if tag not in ('trunk', ''): tag = 'tags/%s' % tag
-		subprocess.call('svn co %s%s %s' %
-				(settings['repo'], tag, source), shell=True)
+		url = settings['repo'] + tag
+		with locked(checkout):
+			if os.path.isdir(os.path.join(checkout, '.svn')):
+				print 'Switching %s to %s' % (path(checkout), url)
+				if subprocess.call('svn switch --non-interactive %s %s' % (url, checkout), shell=True):
+					warning('switch failed, checking out again')
+					shutil.rmtree(checkout, True)
+			if not os.path.isdir(os.path.join(checkout, '.svn')):
+				if subprocess.call('svn co --non-interactive %s %s' % (url, checkout), shell=True):
+					error('could not check out %s' % url)
+			source = tempfile.mkdtemp(prefix='builder.%s.' % name, dir=cache_dir('exports'))
+			exports.add(source)
+			# Commit times keep unchanged files' mtimes stable for rsync and the md5 caches
+			if subprocess.call('svn export --force -q --config-option '
+					'config:miscellany:use-commit-times=yes %s %s' % (checkout, source), shell=True):
+				error('could not export %s' % path(checkout))
+			os.utime(checkout + '.lock', None)
+			checkout_size(checkout, measure=True)
+		evict_checkouts(settings.get('checkout_cache', 10240), checkout)
 	else: error('no repo or directory defined')
 	return source
 
 def get_instance(ec2, hostname):
-	""" Return an ec2 instance given a hostname or return None """
+	"""
+	Return an ec2 instance given a hostname or return None
+
+	The instance is looked up in the inventory snapshot first, and only
+	fetched from EC2 if it is not in there.
+	"""
+	for info in get_inventory(ec2).lookup('dns', hostname):
+		if info['state'] in ('pending', 'running', 'stopping', 'stopped'):
+			instance = Instance(ec2)
+			instance.id, instance.image_id = info['id'], info['image_id']
+			instance.state, instance.public_dns_name = info['state'], hostname
+			return instance
 	for reservation in ec2.get_all_instances(filters={'dns-name':hostname}):
 		for instance in reservation.instances:
 			if instance.public_dns_name == hostname:
 				return instance
 	return None
 
+def wait_ssh(host, key, timeout=300):
+	"""
+	Wait until we can log in to host, aborting after timeout seconds.
+
+	Port 22 is probed with plain tcp connects, backing off from half a second
+	up to five, before any ssh handshake is attempted.  The key is installed
+	late in boot so a refused key is retried for a little while before it is
+	reported as an authentication failure.  Other ssh errors, like an
+	unreadable key or a bad host key, abort at once.
+	"""
+	deadline, delay = time.time() + timeout, 0.5
+	while 1:
+		try:
+			socket.create_connection((host, 22), 2).close()
+			break
+		except socket.error: pass
+		if time.time() + delay > deadline:
+			error('%s still booting after %s seconds' % (host, timeout))
+		time.sleep(delay)
+		delay = min(delay * 2, 5)
+	refused = 0
+	while 1:
+		try:
+			ssh(host, key, 'true')
+			return
+		except paramiko.AuthenticationException, e:
+			refused += 1
+			if refused > 5: error('authentication to %s failed: %s' % (host, e))
+		except (socket.error, EOFError):
+			pass # sshd is listening but not ready yet
+		except paramiko.SSHException, e:
+			# A bad key or host key will not get better by waiting
+			if 'protocol banner' not in str(e): error('could not connect to %s: %s' % (host, e))
+		if time.time() + delay > deadline:
+			error('%s still booting after %s seconds' % (host, timeout))
+		time.sleep(delay)
+		delay = min(delay * 2, 5)
+
+class InstancePoller(threading.Thread):
+	"""
+	Refresh a set of instances until none of them are pending.
+
+	Each round refreshes every pending instance with a single DescribeInstances
+	call.  The delay between rounds grows from delay up to limit seconds and
+	doubles whenever the API asks us to slow down.
+	"""
+	def __init__(self, ec2, instances, delay=2, limit=20):
+		self.ec2       = ec2
+		self.instances = dict((i.id, i) for i in instances)
+		self.events    = dict((i.id, threading.Event()) for i in instances)
+		self.delay     = delay
+		self.limit     = limit
+		self.exception = None
+		super(InstancePoller, self).__init__()
+		self.daemon    = True
+
+	def run(self):
+		pending, delay = dict(self.instances), self.delay
+		try:
+			while pending:
+				time.sleep(delay)
+				try:
+					reservations = self.ec2.get_all_instances(instance_ids=pending.keys())
+				except boto.exception.EC2ResponseError, e:
+					if e.error_code == 'InvalidInstanceID.NotFound': continue
+					if e.error_code != 'RequestLimitExceeded': raise
+					delay = min(delay * 2, self.limit * 2)
+					continue
+				for r in reservations:
+					for i in r.instances:
+						if i.id in pending and i.state != 'pending':
+							pending.pop(i.id)._update(i)
+							self.events[i.id].set()
+				delay = min(delay * 1.5, self.limit)
+		except Exception, e:
+			self.exception = e
+			for event in self.events.values(): event.set()
+
+	def wait(self, instance):
+		""" Block until instance has left the pending state """
+		self.events[instance.id].wait()
+		if self.exception: raise self.exception
+
 def symlinks(machine, source, key):
+	"""
+	Link every file under deploy/<machine name> into place on the machine.
+
+	The current state of every link is fetched in one call and only those
+	that are missing or point elsewhere are changed.  A regular file in the
+	way is moved aside with a timestamp first.
+	"""
 	path  = os.path.join(source, 'deploy', machine['name'])
 	root  = os.path.join('/srv', 'active', 'deploy', machine['name'])
 	links = {}
 	for cur, dirs, files in os.walk(path):
 		for f in files:
 			name = os.path.join(cur, f)[len(path):]
-			links[root+name] = name
-	command = '''
-test -a %(new)s && sudo mv %(new)s %(new)s.`date +%%m:%%d:%%H:%%M`;
-sudo ln -s %(old)s %(new)s'''
-	ssh(machine['host'], key, ';'.join(
-		command % {'old':k, 'new':v} for k,v in links.iteritems()))
-
-def build(ec2, env, source):
-    """
-    Brings up generic instances for each machine type and installs software and services
-    as specified in your recipe.
-    """
+			links[name] = root+name
+	if not links: return
+	current = dict(line.split('\t', 1) for line in ssh(machine['host'], key,
+		'for f in %s; do if test -L "$f"; then echo "$f\tL`readlink "$f"`"; '
+		'elif test -e "$f"; then echo "$f\tF"; else echo "$f\t-"; fi; done'
+		% ' '.join(pipes.quote(name) for name in sorted(links)), quiet=True).splitlines())
+	commands = []
+	for name, target in sorted(links.iteritems()):
+		state = current.get(name, '-')
+		if state == 'L' + target: continue
+		command = 'sudo ln -sfn %s %s' % (pipes.quote(target), pipes.quote(name))
+		if state == 'F':
+			command = 'sudo mv %(new)s %(new)s.`date +%%m:%%d:%%H:%%M` && %(ln)s' % {
+				'new':pipes.quote(name), 'ln':command}
+		commands.append(command)
+	if commands: ssh(machine['host'], key, ';'.join(commands))
+	log(machine['name'], 'Linked %s file%s, skipped %s already in place' % (len(commands),
+		len(commands) != 1 and 's' or '', len(links) - len(commands)))
+
+def build(ec2, env, source, jobs=1, script=False, poll=2):
+	"""
+	Brings up generic instances for each machine type and installs software and services
+	as specified in your recipe.
+
+	Every instance is requested up front and then provisioned on a pool of at
+	most jobs threads.  With script each machine's init commands are run as
+	one remote script.  New instances are first polled after poll seconds.
+
+	Once an instance has run its init commands it is imaged by the returned
+	ImageBaker, remembered in ~/.builder/bases.json by base image and init
+	commands, and later builds launch from that image instead so there is
+	nothing left for init to do.
+	"""
 	print 'Building servers'
 	if isinstance(env, dict): env=[env]
-	for machine in env:
-		image = ec2.get_image(machine['base'])
-		key   = get_key(source, machine['key_pair'])
-		print 'Requesting %s' % machine['name']
-		res = image.run(key_name=machine['key_pair'],
-				security_groups=machine['groups'],
-				instance_type=machine['size'])
-		i = res.instances[0]
-		i.add_tag('Name', machine['name'])
-		time.sleep(10)
-
-        #  Poll AWS as to it's opinon of the server state. 
-		while i.update() == 'pending':
-			print 'Waiting ten seconds on %s' % i
-			time.sleep(10)
+	keys = [get_key(source, machine['key_pair']) for machine in env]
+	bases = ImageBaker(ec2, filename='bases.json')
+	fingerprints = [base_fingerprint(machine) for machine in env]
+	with trace.span('base images'): cached = bases.available(fingerprints)
+
+	# Launch machines sharing an image, size, groups and key pair together
+	specs, instances = {}, [None] * len(env)
+	for n, (machine, fingerprint) in enumerate(zip(env, fingerprints)):
+		specs.setdefault((cached.get(fingerprint, machine['base']), machine['size'],
+			tuple(machine['groups']), machine['key_pair']), []).append(n)
+	for (base, size, groups, key_pair), ns in sorted(specs.iteritems()):
+		print 'Requesting %s %s instance%s of %s' % (len(ns), size,
+				len(ns)>1 and 's' or '', base)
+		with trace.span('launch', base=base, size=size, count=len(ns)):
+			res = ec2.run_instances(base, min_count=len(ns), max_count=len(ns),
+					key_name=key_pair, security_groups=list(groups),
+					instance_type=size)
+		for n, i in zip(ns, res.instances): instances[n] = i
+	names = {}
+	for machine, i in zip(env, instances):
+		names.setdefault(machine['name'], []).append(i.id)
+	for name, ids in names.iteritems():
+		ec2.create_tags(ids, {'Name':name})
+	poller = InstancePoller(ec2, instances, poll, poll * 10)
+	poller.start()
+	get_inventory(ec2).invalidate()
+
+	def provision((machine, key, i, fingerprint)):
+		name = machine['name']
+
+		#  Poll AWS as to it's opinon of the server state.
+		log(name, 'Waiting on %s' % i)
+		with trace.span('pending', machine=name):
+			poller.wait(i)
+		if i.state != 'running':
+			error('%s is %s' % (i, i.state))
 		if 'host' in machine:
-			warning('%s has been replaced' % machine['host'])
+			log(name, alert('warning: ') + '%s has been replaced' % machine['host'])
 			#TODO: Terminate?  ec2.get_all_instances(filters={'dns-name':machine['host']})
 		machine['host'] = i.public_dns_name
 
-        # VM is up but linux isn't booted yet. Try ssh until we can log in.
-		while 1:
-			try:
-				print 'Seeing if %s is actually online' % machine['host']
-				ssh(machine['host'], key, 'echo "hi!"')
-				break
-			except:
-				print 'Nope, trying again in five seconds'
-				time.sleep(5)
+		# VM is up but linux isn't booted yet. Wait until we can log in.
+		log(name, 'Seeing if %s is actually online' % machine['host'])
+		with trace.span('ready', machine=name):
+			wait_ssh(machine['host'], key, machine.get('boot_timeout', 300))
+
+		# run the commands in our recipe
+		with trace.span('init commands', machine=name):
+			init(machine, key, script)
+		if fingerprint not in cached:
+			with trace.span('image', machine=name):
+				bases.bake(fingerprint, i, name)
+		with trace.span('symlinks', machine=name):
+			symlinks(machine, source, key)
+		log(name, 'Built %s' % machine['host'])
+
+	failed = parallel(provision, zip(env, keys, instances, fingerprints), jobs)
+	summarize('Built', 'build', len(env) - len(failed), len(env),
+			[('%s %s' % (machine['name'], i.id), e) for (machine, key, i, f), e in failed])
+	return bases
+
+def init(machine, key, script=False):
+	"""
+	Run a machine's init commands, skipping those it has already run.
+
+	Each step is fingerprinted along with every step before it, and the
+	fingerprint is appended to ~/.builder/init on the host once the step
+	succeeds, so after a recipe changes only the steps from the first
+	changed one on are run again.
+	"""
+	name, fingerprint, steps = machine['name'], '', []
+	for command in machine['init']:
+		fingerprint = hashlib.md5(fingerprint + command).hexdigest()
+		steps.append((command, fingerprint))
+	done = set(ssh(machine['host'], key, 'cat ~/.builder/init 2>/dev/null; mkdir -p ~/.builder',
+			name=name, quiet=True).split())
+	n = 0
+	while n < len(steps) and steps[n][1] in done: n += 1
+	if n: log(name, 'Skipping %s init step%s already run' % (n, n>1 and 's' or ''))
+	run_commands(machine, key, [command for command, fingerprint in steps[n:]], script,
+			['echo %s >> ~/.builder/init' % fingerprint for command, fingerprint in steps[n:]])
+
+def provision(env, source, jobs=1, script=False):
+	""" Bring existing machines up to date with their init commands and symlinks """
+	print 'Provisioning servers'
+	for machine in env:
+		if 'host' not in machine: error('%s has no host entry' % machine['name'])
+	keys = [get_key(source, machine['key_pair']) for machine in env]
 
+	def converge((machine, key)):
+		with trace.span('init commands', machine=machine['name']):
+			init(machine, key, script)
+		with trace.span('symlinks', machine=machine['name']):
+			symlinks(machine, source, key)
+		log(machine['name'], 'Provisioned %s' % machine['host'])
 
-        # run the commands in our recipe
-		for command in machine['init']:
-			print 'Running [%s]' % command
-			ssh(machine['host'], key, command)
-		symlinks(machine, source, key)
+	failed = parallel(converge, zip(env, keys), jobs)
+	summarize('Provisioned', 'provision', len(env) - len(failed), len(env),
+			[(machine['name'], e) for (machine, key), e in failed])
+
+def tree_fingerprint(source):
+	"""
+	Return a hash of the content of every file in source.  File hashes of
+	directories that outlive the run are cached under ~/.builder/trees so
+	unchanged files are not read again.
+	"""
+	cache_file = os.path.join(cache_dir('trees'),
+			'%s.json' % hashlib.md5(os.path.abspath(source)).hexdigest())
+	cache = os.path.exists(cache_file) and json.load(open(cache_file)) or {}
+	if source in exports: cache_file = None
+	hashes = {}
+	for root, dirs, files in os.walk(source):
+		if '.svn' in dirs: dirs.remove('.svn')
+		for file in files:
+			filename = os.path.join(root, file)
+			if os.path.isfile(filename):
+				name = os.path.relpath(filename, source)
+				hashes[name] = cached_md5(cache, name, filename)
+	if cache_file: write_atomic(cache_file, json.dumps(dict((k, cache[k]) for k in hashes)))
+	return hashlib.sha1(json.dumps(sorted(hashes.items()))).hexdigest()
+
+def role_fingerprint(machine, tree):
+	""" Return a hash of what goes into an image of machine given a source tree hash """
+	return hashlib.sha1(json.dumps([machine['name'], machine['base'],
+		machine['init'], machine['update'], tree])).hexdigest()
+
+def base_fingerprint(machine):
+	""" Return a hash of what goes into an image of machine before any code is pushed """
+	return hashlib.sha1(json.dumps([machine['base'], machine['init']])).hexdigest()
+
+class ImageBaker(object):
+	"""
+	Create at most one image per fingerprint and poll them in the background.
 
-def update(ec2, env, source):
+	Images are created without rebooting the instance.  Images that become
+	available are remembered by fingerprint in ~/.builder/<filename> and are
+	reused by later deploys with the same fingerprint while they still exist.
+	Every pending image is refreshed with one DescribeImages call per round.
+	An image EC2 still does not know after max_missing rounds counts as failed.
+	"""
+	def __init__(self, ec2, delay=10, filename='images.json', max_missing=30):
+		self.ec2     = ec2
+		self.delay   = delay
+		self.max_missing = max_missing
+		self.file    = os.path.join(cache_dir(), filename)
+		self.known   = self.load() # fingerprint -> {'image', 'name', 'created'}
+		self.forgotten = set() # fingerprints pruned since the last save
+		self.images  = {} # fingerprint -> image id for this run
+		self.pending = {} # image id -> (fingerprint, name)
+		self.missing = {} # image id -> rounds it was not found
+		self.failed  = []
+		self.error   = None
+		self.lock    = threading.Lock()
+		self.poller  = None
+
+	def load(self):
+		known = {}
+		for fingerprint, entry in (os.path.exists(self.file) and json.load(open(self.file)) or {}).iteritems():
+			if not isinstance(entry, dict): entry = {'image':entry, 'name':None, 'created':0}
+			known[fingerprint] = entry
+		return known
+
+	def exists(self, image):
+		try: return bool(self.ec2.get_all_images(image_ids=[image]))
+		except boto.exception.EC2ResponseError: return False
+
+	def find(self, image):
+		try: return self.ec2.get_all_images(image_ids=[image])
+		except boto.exception.EC2ResponseError, e:
+			if e.error_code == 'InvalidAMIID.NotFound': return []
+			raise
+
+	def available(self, fingerprints):
+		""" Return {fingerprint: image} for those of fingerprints with a known image that still exists """
+		images = dict((self.known[f]['image'], f) for f in set(fingerprints) if f in self.known)
+		if not images: return {}
+		try: found = [i.id for i in self.ec2.get_all_images(image_ids=images.keys())]
+		except boto.exception.EC2ResponseError: # One is gone, so ask about each
+			found = [image for image in images if self.exists(image)]
+		return dict((images[image], image) for image in found)
+
+	def bake(self, fingerprint, instance, name):
+		""" Return the image for fingerprint, creating it from instance if need be """
+		with self.lock:
+			if fingerprint in self.images: return self.images[fingerprint]
+			image = self.known.get(fingerprint, {}).get('image')
+			if image and self.exists(image):
+				log(name, 'Reusing image %s' % image)
+			else:
+				now = datetime.datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
+				image = self.ec2.create_image(instance.id,
+						'%s %s %s' % (name, now, fingerprint[:8]),
+						description='Image of %s on %s' % (name, now), no_reboot=True)
+				log(name, 'Creating image %s' % image)
+				self.pending[image] = (fingerprint, name)
+				if not self.poller:
+					self.poller = threading.Thread(target=self.poll)
+					self.poller.daemon = True
+					self.poller.start()
+			self.images[fingerprint] = image
+			return image
+
+	def poll(self):
+		try: self.rounds()
+		except Exception, e: # Let wait() report it rather than wait forever
+			with self.lock: self.poller, self.error = None, e
+
+	def rounds(self):
+		while 1:
+			time.sleep(self.delay)
+			with self.lock:
+				if not self.pending:
+					self.poller = None
+					return
+				pending = self.pending.keys()
+			try:
+				try: images = self.ec2.get_all_images(image_ids=pending)
+				except boto.exception.EC2ResponseError, e:
+					if e.error_code != 'InvalidAMIID.NotFound': raise
+					# Some are not visible yet, so ask about each
+					images = [i for image in pending for i in self.find(image)]
+			except (boto.exception.EC2ResponseError, socket.error, httplib.HTTPException):
+				continue # Try again next round
+			with self.lock:
+				found = set(image.id for image in images)
+				for image in pending:
+					if image in found: self.missing.pop(image, None)
+					else: self.missing[image] = self.missing.get(image, 0) + 1
+					if self.missing.get(image, 0) >= self.max_missing:
+						name = self.pending.pop(image)[1]
+						self.missing.pop(image)
+						log(name, alert('warning: ') + 'image %s was never found' % image)
+						self.failed.append(image)
+				for image in images:
+					if image.state == 'available':
+						fingerprint, name = self.pending.pop(image.id)
+						self.known[fingerprint] = {'image':image.id, 'name':name, 'created':time.time()}
+					elif image.state == 'failed':
+						self.pending.pop(image.id)
+						self.failed.append(image.id)
+				self.save()
+
+	def save(self):
+		""" Merge known into the file, keeping what other bakers wrote since it was read """
+		with locked(self.file):
+			known = self.load()
+			for fingerprint in self.forgotten: known.pop(fingerprint, None)
+			known.update(self.known)
+			write_atomic(self.file, json.dumps(known, indent=4))
+			self.known, self.forgotten = known, set()
+
+	def wait(self):
+		""" Block until every image is available, aborting if any failed """
+		while self.poller: time.sleep(1)
+		if self.error: error('could not poll images: %s' % self.error)
+		if self.failed: error('image%s %s failed' % (len(self.failed)>1 and 's' or '',
+			', '.join(self.failed)))
+
+	def prune(self, keep=2, max_age=30):
+		"""
+		Deregister the images, and their snapshots, beyond the newest keep
+		of each machine or older than max_age days, and forget them.
+		"""
+		now, machines = time.time(), {}
+		for fingerprint, entry in self.known.items():
+			machines.setdefault(entry['name'], []).append((entry['created'], fingerprint))
+		for name, entries in machines.iteritems():
+			for n, (created, fingerprint) in enumerate(sorted(entries, reverse=True)):
+				if n < keep and now - created < max_age * 86400: continue
+				image = self.known.pop(fingerprint)['image']
+				self.forgotten.add(fingerprint)
+				try:
+					snapshots = [d.snapshot_id for i in self.ec2.get_all_images(image_ids=[image])
+						for d in (i.block_device_mapping or {}).values() if d.snapshot_id]
+					self.ec2.deregister_image(image)
+					for snapshot in snapshots: self.ec2.delete_snapshot(snapshot)
+				except boto.exception.EC2ResponseError, e:
+					if e.error_code != 'InvalidAMIID.NotFound': raise
+				log(name, 'Deregistered image %s' % image)
+		self.save()
+
+def make_artifact(source):
+	""" Pack source into a compressed tarball and return its path """
+	artifact = os.path.join(tempfile.mkdtemp(prefix='builder.artifact.'),
+			'%s.tar.gz' % os.path.basename(source))
+	if subprocess.call('tar czf %s --exclude=.svn -C %s %s' % (artifact,
+			os.path.dirname(source), os.path.basename(source)), shell=True):
+		error('could not pack %s' % path(source))
+	return artifact
+
+def push_artifact(host, key, artifact, release, user='ubuntu'):
+	""" Stream a tarball made by make_artifact() into the release directory on host """
+	with connections.session(host, key, user) as channel:
+		channel.exec_command('mkdir -p %s && tar xzf - -C %s --strip-components=1' % (release, release))
+		with open(artifact, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 16), ''):
+				channel.sendall(chunk)
+		channel.shutdown_write()
+		e = channel.makefile_stderr('rb', -1).read()
+		if channel.recv_exit_status(): error('unpacking on %s failed: %s' % (host, e))
+
+def activate(release):
+	""" Return a command that atomically points /srv/active at release """
+	return 'ln -sfn %s /srv/active.new && mv -T /srv/active.new /srv/active' % release
+
+def prune_releases(active, keep=5):
+	""" Return a command that removes all but the newest keep releases, never active """
+	return 'ls -1d /srv/releases/* | sort -r | tail -n +%s | grep -vx %s | xargs -r rm -rf' % (
+		keep + 1, active)
+
+def rollback(env, source, jobs=1, script=False):
+	""" Switch every machine back to its release before /srv/active and run the update commands """
+	print 'Rolling back servers'
+	for machine in env:
+		if 'host' not in machine: error('%s has no host entry' % machine['name'])
+	keys = [get_key(source, machine['key_pair']) for machine in env]
+
+	def back((machine, key)):
+		result = execute(machine['host'], key, 'readlink -e /srv/active && ls -1d /srv/releases/*',
+			name=machine['name'], quiet=True)
+		active, releases = (result.out.split() + [''])[0], sorted(result.out.split()[1:])
+		if active not in releases or not releases.index(active):
+			error('%s has no release before %s' % (machine['host'], active or '/srv/active'))
+		release = releases[releases.index(active) - 1]
+		ssh(machine['host'], key, activate(release))
+		log(machine['name'], 'Rolled back to %s' % release)
+		with trace.span('update commands', machine=machine['name']):
+			run_commands(machine, key, machine['update'], script)
+
+	failed = parallel(back, zip(env, keys), jobs)
+	summarize('Rolled back', 'roll back', len(env) - len(failed), len(env),
+			[(machine['name'], e) for (machine, key), e in failed])
+
+def healthy(host, target, timeout=5):
+	""" Return whether host passes an ELB health check target such as HTTP:80/ """
+	protocol, rest = target.split(':', 1)
+	port, url = (rest.split('/', 1) + [''])[:2]
+	try:
+		if protocol.upper() in ('HTTP', 'HTTPS'):
+			connection = (protocol.upper() == 'HTTP' and httplib.HTTPConnection
+					or httplib.HTTPSConnection)(host, int(port), timeout=timeout)
+			connection.request('GET', '/' + url)
+			return connection.getresponse().status == 200
+		socket.create_connection((host, int(port)), timeout).close()
+		return True
+	except (socket.error, httplib.HTTPException):
+		return False
+
+def rolling_batches(env, rolling):
+	""" Split env into batches of rolling machines, or a percentage like 25% """
+	if rolling.endswith('%'): size = int(math.ceil(len(env) * float(rolling[:-1]) / 100))
+	else: size = int(rolling)
+	size = max(1, size)
+	return [env[n:n + size] for n in range(0, len(env), size)]
+
+def rejoin(elb, machine, instance, timeout=300):
+	"""
+	Wait for machine to pass its load balancer's health check target, then
+	register it again and wait for the load balancer to put it in service.
+	"""
+	load_balancer = machine['load_balancer']
+	target = load_balancer.get('health_check', {}).get('target', 'HTTP:80/')
+	deadline, delay = time.time() + timeout, 1
+	log(machine['name'], 'Waiting for %s to pass %s' % (machine['host'], target))
+	while not healthy(machine['host'], target):
+		if time.time() + delay > deadline:
+			error('%s failed %s after %s seconds' % (machine['host'], target, timeout))
+		time.sleep(delay)
+		delay = min(delay * 2, 10)
+	elb.register_instances(load_balancer['name'], [instance.id])
+	while [s for s in elb.describe_instance_health(load_balancer['name'], [instance.id])
+			if s.state != 'InService']:
+		if time.time() + delay > deadline:
+			error('%s not in service after %s seconds' % (machine['host'], timeout))
+		time.sleep(delay)
+		delay = min(delay * 2, 10)
+	log(machine['name'], 'Back in service on %s' % load_balancer['name'])
+
+def update(ec2, env, source, jobs=1, artifact=False, rolling=None, script=False):
+	"""
+	Push the source to every machine, switch /srv/active to it and run the
+	update commands, on a pool of at most jobs threads.
+
+	Each update goes into a new directory under /srv/releases.  rsync seeds
+	it with hard links to the release /srv/active points at, so only changed
+	files are sent or stored, and /srv/active is switched to it atomically.
+	All but the newest keep_releases releases of a machine are removed.
+
+	With artifact the source is packed into one tarball that is streamed to
+	every host instead of running rsync against each of them.  With script
+	the switch and the update commands are run as one remote script.
+
+	Each machine is imaged in the background by the returned ImageBaker, at
+	most once per distinct role and source.
+
+	With rolling, a number of machines or a percentage, machines are updated
+	in batches of that size.  Each machine behind a load balancer is taken
+	out of it while it is updated and only put back once it passes the
+	health check target, and the next batch only starts once the whole
+	batch is back in service.  When a batch fails the machines that did
+	update are still put back, and those left out are named.
+	"""
 	print 'Updating servers'
 	for machine in env:
-		key = get_key(source, machine['key_pair'])
 		if 'host' not in machine: error('%s has no host entry' % machine['name'])
-		target = '/srv/%s' % os.path.basename(source)
-		ssh(machine['host'], key,
-			'test -a %(path)s && mv %(path)s %(path)s.`date +%%m:%%d:%%H:%%M`' % {'path':target})
-		print 'Deploying code'
-		subprocess.call('rsync -aze "ssh -o StrictHostKeyChecking=no -i %s" %s ubuntu@%s:/srv' % (key, source, machine['host']), shell=True) #TODO:Username?
-		ssh(machine['host'], key, 'rm /srv/active; ln -s %s /srv/active' % target)
-		for command in machine['update']:
-			print 'Running [%s]' % command
-			ssh(machine['host'], key, command)
+	keys = [get_key(source, machine['key_pair']) for machine in env]
+	if artifact:
+		with trace.span('artifact'): artifact = make_artifact(source)
+	with trace.span('fingerprint'): tree = tree_fingerprint(source)
+	release = '/srv/releases/%s-%s' % (time.strftime('%Y%m%d%H%M%S'), tree[:8])
+	baker = ImageBaker(ec2)
+
+	def deploy((machine, key)):
+		name = machine['name']
+		previous = ssh(machine['host'], key, 'mkdir -p /srv/releases; readlink -e /srv/active || true',
+			quiet=True).strip()
+		log(name, 'Deploying code to %s' % release)
+		with trace.span('push', machine=name):
+			if artifact: push_artifact(machine['host'], key, artifact, release)
+			elif subprocess.call('rsync -aze "ssh -o StrictHostKeyChecking=no -i %s" %s %s/ ubuntu@%s:%s' % (key,
+					previous and '--link-dest=%s' % previous or '', source, machine['host'], release), shell=True): #TODO:Username?
+				error('rsync to %s failed' % machine['host'])
+		swap = '%s && %s' % (activate(release), prune_releases(release, machine.get('keep_releases', 5)))
+		if not script: ssh(machine['host'], key, swap)
+		with trace.span('update commands', machine=name):
+			run_commands(machine, key, (script and [swap] or []) + machine['update'], script)
 		if 'url' in machine:
 			webbrowser.open('http://%s%s' % (machine['host'], machine['url']))
 
-		# Image the updated instance
-		instance = get_instance(ec2, machine['host'])
-		now = datetime.datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
-		machine['image'] = ec2.create_image(instance.id, '%s %s' % (machine['name'],now), 
-				description='Image of %s on %s' % (machine['name'],now))
+		# Image the updated instance, once per role and source
+		with trace.span('image', machine=name):
+			instance = get_instance(ec2, machine['host'])
+			machine['image'] = baker.bake(role_fingerprint(machine, tree),
+					instance, machine['name'])
+
+	batches = rolling and rolling_batches(zip(env, keys), rolling) or [zip(env, keys)]
+	elb = rolling and boto.connect_elb(ec2.access_key, ec2.secret_key)
+	succeeded, failed = 0, []
+	try:
+		for n, batch in enumerate(batches):
+			if rolling: print 'Updating batch %s of %s' % (n + 1, len(batches))
+
+			# Take the batch out of its load balancers
+			balanced = []
+			for machine, key in rolling and batch or []:
+				if machine.get('load_balancer', {}).get('name'):
+					instance = get_instance(ec2, machine['host'])
+					if not instance: continue
+					log(machine['name'], 'Leaving %s' % machine['load_balancer']['name'])
+					elb.deregister_instances(machine['load_balancer']['name'], [instance.id])
+					balanced.append((machine, instance))
+
+			failed = parallel(deploy, batch, jobs)
+
+			# Put back every machine that deployed, even if others in the batch did not
+			broken = set(machine['name'] for (machine, key), e in failed)
+			def health((machine, instance)):
+				with trace.span('health', machine=machine['name']):
+					rejoin(elb, machine, instance, machine.get('health_timeout', 300))
+			unhealthy = parallel(health, [(machine, instance) for machine, instance in balanced
+				if machine['name'] not in broken], jobs)
+			for machine, instance in [(machine, instance) for machine, instance in balanced
+					if machine['name'] in broken] + [item for item, e in unhealthy]:
+				warning('%s (%s) is left out of service on %s' % (instance.id,
+					machine['name'], machine['load_balancer']['name']))
+			failed += [((machine, None), e) for (machine, instance), e in unhealthy]
+			succeeded += len(batch) - len(failed)
+			if failed: break
+	finally:
+		if artifact: shutil.rmtree(os.path.dirname(artifact))
+	summarize('Updated', 'update', succeeded, len(env),
+			[(machine['name'], e) for (machine, key), e in failed])
+	return baker
+
+def same(a, b):
+	""" Return whether two settings are equal, comparing numbers by value """
+	try: return float(a) == float(b)
+	except (TypeError, ValueError): return str(a) == str(b)
+
+def reconcile(stages, dry_run=False, jobs=4):
+	"""
+	Print a plan of changes and, unless dry_run, make them.
 
-def load_balance(ec2, env):
-	""" Create the load balancers if they do not exist """
+	Each change is a (description, fn, args) tuple.  Stages are applied one
+	after another and the changes within a stage, which must not depend on
+	each other, concurrently.
+	"""
+	changes = [change for stage in stages for change in stage]
+	for description, fn, args in changes: print '\t%s' % description
+	if not changes: print '\tNothing to change'
+	if dry_run: return
+	for stage in stages:
+		failed = parallel(lambda (description, fn, args): fn(*args), stage, jobs)
+		for (description, fn, args), e in failed:
+			print '\t%s\t%s' % (description, alert(e))
+		if failed: error('%s change%s failed' % (len(failed), len(failed)>1 and 's' or ''))
+
+def load_balance(ec2, env, dry_run=False, jobs=4):
+	""" Create the load balancers that do not exist and correct their health checks """
+	machines = [machine for machine in env if 'load_balancer' in machine]
+	if not machines: return
+	print 'Load balancing'
 	elb = boto.connect_elb(ec2.access_key, ec2.secret_key)
-	for machine in env:
-		if 'load_balancer' in machine.keys():
-			load_balancer = machine['load_balancer']
-			
-			# Set the defaults
-			availability_zones = machine.get('availability_zones',['us-east-1a', 'us-east-1c', 'us-east-1d'])
-			lb_name            = load_balancer.get('name',{})
-			lb_listeners       = load_balancer.get('listeners',[(80, 80, 'http')])
-			health_check       = load_balancer.get('health_check',{})
-
-			try:
-				new_lb = elb.get_all_load_balancers(load_balancer_names=[lb_name])[0]
-			except:
-				# Create a health check for the load balancer
-				hc = boto.ec2.elb.HealthCheck(
-						health_check.get('name','instance_health'),
-						interval            = health_check.get('interval', 20),
-						target              = health_check.get('target', 'HTTP:80/'),
-						healthy_threshold   = health_check.get('healthy_threshold',2),
-						timeout             = health_check.get('timeout',5),
-						unhealthy_threshold = health_check.get('unhealthy_threshold',5),
-						)
-
-				# Create the load balancer if it does not exist
-				new_lb = elb.create_load_balancer(lb_name, availability_zones, lb_listeners)
-				new_lb.configure_health_check(hc)
-				print 'Creating load balancer ', new_lb
-
-			# Set the host
-			machine['load_balancer']['host'] = new_lb.dns_name
-
-def autoscale(ec2, env):
-	""" Autoscale each machine """
+	existing = dict((lb.name, lb) for lb in elb.get_all_load_balancers())
+
+	def create(name, zones, listeners, hc):
+		lb = elb.create_load_balancer(name, zones, listeners)
+		lb.configure_health_check(hc)
+		for machine in machines:
+			if machine['load_balancer'].get('name') == name:
+				machine['load_balancer']['host'] = lb.dns_name
+
+	creates, checks, seen = [], [], set()
+	for machine in machines:
+		load_balancer = machine['load_balancer']
+
+		# Set the defaults
+		availability_zones = machine.get('availability_zones',['us-east-1a', 'us-east-1c', 'us-east-1d'])
+		lb_name            = load_balancer.get('name',{})
+		lb_listeners       = load_balancer.get('listeners',[(80, 80, 'http')])
+		health_check       = load_balancer.get('health_check',{})
+		hc = boto.ec2.elb.HealthCheck(
+				health_check.get('name','instance_health'),
+				interval            = health_check.get('interval', 20),
+				target              = health_check.get('target', 'HTTP:80/'),
+				healthy_threshold   = health_check.get('healthy_threshold',2),
+				timeout             = health_check.get('timeout',5),
+				unhealthy_threshold = health_check.get('unhealthy_threshold',5),
+				)
+
+		lb = existing.get(lb_name)
+		if lb: load_balancer['host'] = lb.dns_name
+		if lb_name in seen: continue
+		seen.add(lb_name)
+		if not lb:
+			creates.append(('+ create load balancer %s' % lb_name, create,
+				(lb_name, availability_zones, lb_listeners, hc)))
+		elif not lb.health_check or not all(same(getattr(lb.health_check, a), getattr(hc, a))
+				for a in ('interval', 'target', 'healthy_threshold', 'timeout', 'unhealthy_threshold')):
+			checks.append(('~ configure health check %s of load balancer %s' % (hc.target, lb_name),
+				elb.configure_health_check, (lb_name, hc)))
+	reconcile([creates + checks], dry_run, jobs)
+
+# Trigger attributes and the names boto gives them on a fetched trigger
+trigger_fields = [('measure_name', 'measure_name'), ('statistic', 'statistic'), ('unit', 'unit'),
+	('period', 'period'), ('breach_duration', 'breach_duration'),
+	('lower_threshold', 'LowerThreshold'), ('upper_threshold', 'UpperThreshold'),
+	('lower_breach_scale_increment', 'LowerBreachScaleIncrement'),
+	('upper_breach_scale_increment', 'UpperBreachScaleIncrement')]
+
+def autoscale(ec2, env, dry_run=False, jobs=4):
+	"""
+	Bring each machine's launch configuration, autoscaling group and trigger
+	in line with its settings.  Launch configurations can't be changed, so a
+	new one named after a hash of its settings is made when they differ.
+	"""
+	machines = [machine for machine in env if 'autoscale' in machine]
+	if not machines: return
+	print 'Autoscaling'
 	asg = boto.connect_autoscale(ec2.access_key, ec2.secret_key)
-	for machine in env:
-		if 'autoscale' in machine.keys():
-			print 'Autoscaling %s' % machine['name']
-			autoscale = machine['autoscale']
-
-			# Set the defaults
-			autoscale_name     = autoscale.get('name','_'.join(machine['name'].split()))
-			launch_config_name = autoscale.get('launch_config_name','launch_config_%s' % autoscale_name)
-			group_name         = autoscale.get('group_name','group_%s' % autoscale_name)
-			trigger_name       = autoscale.get('trigger_name','trigger_%s' % autoscale_name)
-			min_size           = autoscale.get('min_size','1')
-			max_size           = autoscale.get('max_size','4')
-
-			availability_zones = machine.get('availability_zones',['us-east-1a', 'us-east-1c', 'us-east-1d'])
-			load_balancers     = [machine.get('load_balancer',{}).get('name')]
-
-			# Create ec2 launch configuration
-			try:
-				lc = asg.get_all_launch_configurations(names=[launch_config_name])[0]
-			except:
-				lc = LaunchConfiguration(      
-				            name            = launch_config_name,           
-				            image_id        = machine['image'],     
-				            key_name        = machine['key_pair'],
-				            instance_type   = machine['size'],   
-				            security_groups = machine['groups'])
-				asg.create_launch_configuration(lc)
-
-			# Create ec2 autoscaling group
-			try:
-				ag = asg.get_all_groups(names=[group_name])[0]
-				ag.load_balancers     = load_balancers
-				ag.availability_zones = availability_zones
-				ag.launch_config      = lc
-				ag.min_size           = min_size
-				ag.max_size           = max_size
-				ag.update()
-			except:
-				ag = AutoScalingGroup(
-				            group_name         = group_name, 
-				            load_balancers     = load_balancers,
-				            availability_zones = availability_zones,
-				            launch_config      = lc,
-				            min_size           = min_size,
-				            max_size           = max_size)
-				asg.create_auto_scaling_group(ag)
-			
-			# Create ec2 autoscaling group trigger
-			trigger_config = {
-				# Probably NOT a good idea to update these int he config
-				'name'                   : trigger_name,
-				'autoscale_group'        : ag,
-			    'dimensions'             : [('AutoScalingGroupName', ag.name)],
-
-				# These are fine to update in the config
-			    'measure_name'           : 'CPUUtilization',             
-			    'statistic'              : 'Average',
-			    'unit'                   : 'Percent',
-			    'period'                 : '60',
-			    'breach_duration'        : '120',
-			    'lower_threshold'        : '15',
-			    'upper_threshold'        : '30',
-			    'lower_breach_scale_increment' : '-1',
-			    'upper_breach_scale_increment' : '2', 
-
-			}
-			trigger_config.update(autoscale.get('trigger_config',{}))
-			tr = Trigger(**trigger_config)
-			asg.create_trigger(tr)
-
-def s3_percent_cb(complete, total):
-	""" Callback method for s3 bucket """
-	sys.stdout.write('.')
-	sys.stdout.flush()
+	specs = []
+	for machine in machines:
+		autoscale = machine['autoscale']
+
+		# Set the defaults
+		autoscale_name     = autoscale.get('name','_'.join(machine['name'].split()))
+		launch_config_name = autoscale.get('launch_config_name','launch_config_%s' % autoscale_name)
+		group_name         = autoscale.get('group_name','group_%s' % autoscale_name)
+		trigger_name       = autoscale.get('trigger_name','trigger_%s' % autoscale_name)
+		min_size           = autoscale.get('min_size','1')
+		max_size           = autoscale.get('max_size','4')
+
+		availability_zones = machine.get('availability_zones',['us-east-1a', 'us-east-1c', 'us-east-1d'])
+		load_balancers     = [machine.get('load_balancer',{}).get('name')]
+		if 'image' not in machine:
+			warning('%s has no image to autoscale yet' % machine['name'])
+			continue
+		lc = LaunchConfiguration(
+		            name            = launch_config_name,
+		            image_id        = machine['image'],
+		            key_name        = machine['key_pair'],
+		            instance_type   = machine['size'],
+		            security_groups = machine['groups'])
+		ag = AutoScalingGroup(
+		            group_name         = group_name,
+		            load_balancers     = load_balancers,
+		            availability_zones = availability_zones,
+		            launch_config      = lc,
+		            min_size           = min_size,
+		            max_size           = max_size)
+
+		trigger_config = {
+			# Probably NOT a good idea to update these int he config
+			'name'                   : trigger_name,
+			'autoscale_group'        : ag,
+		    'dimensions'             : [('AutoScalingGroupName', ag.name)],
+
+			# These are fine to update in the config
+		    'measure_name'           : 'CPUUtilization',
+		    'statistic'              : 'Average',
+		    'unit'                   : 'Percent',
+		    'period'                 : '60',
+		    'breach_duration'        : '120',
+		    'lower_threshold'        : '15',
+		    'upper_threshold'        : '30',
+		    'lower_breach_scale_increment' : '-1',
+		    'upper_breach_scale_increment' : '2',
+
+		}
+		trigger_config.update(autoscale.get('trigger_config',{}))
+		specs.append((lc, ag, Trigger(**trigger_config), '%s_%s' % (launch_config_name,
+			hashlib.sha1(json.dumps([lc.image_id, lc.key_name, lc.instance_type,
+				sorted(machine['groups'])])).hexdigest()[:8])))
+	if not specs: return
+
+	# Fetch everything that exists in a few calls
+	configs = dict((c.name, c) for c in asg.get_all_launch_configurations(
+		names=[lc.name for lc, ag, tr, alt in specs] + [alt for lc, ag, tr, alt in specs]))
+	groups = dict((g.name, g) for g in asg.get_all_groups(names=[ag.name for lc, ag, tr, alt in specs]))
+	triggers = {}
+	def fetch(group): triggers[group] = dict((t.name, t) for t in asg.get_all_triggers(group))
+	for group, e in parallel(fetch, groups.keys(), jobs): raise e
+
+	launch_configs, updates, scalers = [], [], []
+	for lc, ag, tr, alt in specs:
+		for name in (lc.name, alt):
+			c = configs.get(name)
+			if c and c.image_id == lc.image_id and c.key_name == lc.key_name and \
+					c.instance_type == lc.instance_type and \
+					sorted(c.security_groups) == sorted(lc.security_groups):
+				lc.name = name
+				break
+		else:
+			if lc.name in configs: lc.name = alt
+			launch_configs.append(('+ create launch configuration %s of %s' % (lc.name, lc.image_id),
+				asg.create_launch_configuration, (lc,)))
+		ag.launch_config_name = lc.name
+
+		g = groups.get(ag.name)
+		if not g:
+			updates.append(('+ create autoscaling group %s' % ag.name,
+				asg.create_auto_scaling_group, (ag,)))
+		else:
+			changed = [a for a in ('launch_config_name', 'min_size', 'max_size')
+				if not same(getattr(g, a), getattr(ag, a))]
+			if changed:
+				updates.append(('~ update autoscaling group %s (%s)' % (ag.name, ', '.join(
+					'%s %s -> %s' % (a, getattr(g, a), getattr(ag, a)) for a in changed)), g.update, ()))
+				for a in changed: setattr(g, a, getattr(ag, a))
+
+		t = triggers.get(ag.name, {}).get(tr.name)
+		if not t or not all(same(getattr(t, fetched, None), getattr(tr, a)) for a, fetched in trigger_fields):
+			scalers.append(('%s trigger %s' % (t and '~ update' or '+ create', tr.name),
+				asg.create_trigger, (tr,)))
+	reconcile([launch_configs, updates, scalers], dry_run, jobs)
+
+def md5file(filename):
+	""" Return the hex md5 of a file """
+	md5 = hashlib.md5()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), ''):
+			md5.update(chunk)
+	return md5.hexdigest()
+
+def cached_md5(cache, key, filename):
+	""" Return the md5 of filename, reusing cache[key] if the file is unchanged """
+	stat  = os.stat(filename)
+	entry = cache.get(key)
+	if not entry or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+		entry = cache[key] = {'mtime':stat.st_mtime,
+				'size':stat.st_size, 'md5':md5file(filename)}
+	return entry['md5']
+
+def static_files(source):
+	""" Return (key, filename) for each file in the static directory """
+	static_dir = os.path.join(source,'project','static')
+	for root, dirs, files in os.walk(static_dir):
+		if '.svn' in dirs: dirs.remove('.svn')
+		key_root = root[len(static_dir):]
+
+		for file in files:
+			filename = os.path.join(root,file)
+			if os.path.isfile(filename):
+				yield os.path.join(key_root,file), filename
+
+def s3diff(bucket, files, manifest, delete=False):
+	"""
+	Compare local files to the contents of bucket and return the keys that
+	need to be uploaded and the keys that need to be deleted.
+
+	The bucket is listed once and each file is matched against its key by
+	size and md5.  Hashes are kept in manifest by key so a file is only
+	rehashed when its size or mtime changed.  Multipart uploads do not have
+	an md5 ETag so the ETag recorded after an upload is accepted too.
+	"""
+	remote = dict((k.name, (k.etag.strip('"'), k.size)) for k in bucket.list())
+	uploads, seen = [], set()
+	for key, filename in files:
+		seen.add(key)
+		cached_md5(manifest, key, filename)
+		entry = manifest[key]
+		etag, size = remote.pop(key, (None, None))
+		if size != entry['size'] or etag not in (entry['md5'], entry.get('etag')):
+			uploads.append((key, filename))
+	for key in manifest.keys():
+		if key not in seen: del manifest[key]
+	return uploads, delete and sorted(remote) or []
+
+def gzip_asset((filename, target)):
+	""" Write a reproducible gzip of filename to target """
+	temp = '%s.%s' % (target, os.getpid())
+	with open(filename, 'rb') as f:
+		with open(temp, 'wb') as out:
+			gz = gzip.GzipFile('', 'wb', 9, out, 0)
+			shutil.copyfileobj(f, gz)
+			gz.close()
+	os.rename(temp, target)
+
+def precompress(files, types, hashes):
+	"""
+	Gzip the text assets among (key, filename) files on every core.
+
+	Returns (key, filename, compressed) for each file, with filename pointing
+	at the compressed copy when compressing made the asset smaller.  Copies
+	are cached under ~/.builder/gzip by the md5 of their content, which is
+	itself cached in hashes, so unchanged files are not compressed again.
+	"""
+	directory, assets, work = cache_dir('gzip'), [], {}
+	for key, filename in files:
+		if key.split('.')[-1].lower() not in types:
+			assets.append((key, filename, None))
+			continue
+		target = os.path.join(directory, '%s.gz' % cached_md5(hashes, key, filename))
+		if not os.path.exists(target): work[target] = filename
+		assets.append((key, filename, target))
+	keys = set(key for key, filename in files)
+	for key in hashes.keys():
+		if key not in keys: del hashes[key]
+	if work:
+		print 'Compressing %s file%s' % (len(work), len(work)>1 and 's' or '')
+		pool = multiprocessing.Pool()
+		pool.map(gzip_asset, [(f, t) for t, f in work.iteritems()])
+		pool.close()
+		pool.join()
+	return [target and os.path.getsize(target) < os.path.getsize(filename)
+			and (key, target, True) or (key, filename, False)
+			for key, filename, target in assets]
+
+def connect_s3(ec2, s3bucket={}):
+	""" Connect to S3, or to the S3 compatible host named in a bucket config """
+	kwargs = {}
+	if 'host' in s3bucket:
+		kwargs = {'host':s3bucket['host'], 'port':s3bucket.get('port'),
+			'is_secure':s3bucket.get('secure', False),
+			'calling_format':OrdinaryCallingFormat()}
+	return boto.connect_s3(ec2.access_key, ec2.secret_key, **kwargs)
+
+class S3Transfer(object):
+	"""
+	Upload files to a bucket from a pool of jobs threads.
+
+	Every thread has its own connection.  Files of threshold bytes or more
+	are sent as multipart uploads and their chunk sized parts are spread over
+	the same pool as the other files.  Progress is reported as files/s and
+	MB/s at most once a second.
+	"""
+	def __init__(self, connect, name, jobs=8, threshold=16 << 20, chunk=8 << 20):
+		self.connect   = connect
+		self.name      = name
+		self.jobs      = jobs
+		self.threshold = threshold
+		self.chunk     = chunk
+		self.local     = threading.local()
+		self.lock      = threading.Lock()
+
+	def bucket(self):
+		""" Return this thread's bucket """
+		if not hasattr(self.local, 'bucket'):
+			self.local.bucket = self.connect().get_bucket(self.name, validate=False)
+		return self.local.bucket
+
+	def upload(self, uploads):
+		"""
+		Send each (key, filename, headers, md5) in uploads, publicly readable.
+		Returns the ETag of every key sent.
+		"""
+		bucket, tasks, multiparts = self.bucket(), [], []
+		self.started, self.reported = time.time(), 0
+		self.files, self.bytes, self.etags = 0, 0, {}
+		self.total = len(uploads)
+		for key, filename, headers, md5 in uploads:
+			size = os.path.getsize(filename)
+			if size < self.threshold:
+				tasks.append((key, filename, headers, md5, None, 0, size))
+				continue
+			headers = dict(headers, **{'x-amz-acl':'public-read'})
+			mp = bucket.initiate_multipart_upload(key, headers=headers)
+			multiparts.append(mp)
+			for n, offset in enumerate(range(0, size, self.chunk)):
+				tasks.append((key, filename, headers, None, (mp.id, n + 1),
+					offset, min(self.chunk, size - offset)))
+		failed = parallel(self.send, tasks, self.jobs)
+		failed = set(task[0] for task, e in failed)
+		for mp in multiparts:
+			if mp.key_name in failed:
+				mp.cancel_upload()
+				continue
+			etag = bucket.complete_multipart_upload(mp.key_name, mp.id, mp.to_xml()).etag
+			self.etags[mp.key_name] = etag.strip('"')
+			self.files += 1
+		self.report(True)
+		if failed: error('failed to upload %s' % ', '.join(sorted(failed)))
+		return self.etags
+
+	def send(self, (key, filename, headers, md5, part, offset, size)):
+		""" Send a whole file or one part of a multipart upload """
+		bucket = self.bucket()
+		if part:
+			mp = MultiPartUpload(bucket)
+			mp.key_name, mp.id = key, part[0]
+			with open(filename, 'rb') as f:
+				f.seek(offset)
+				mp.upload_part_from_file(StringIO.StringIO(f.read(size)), part[1])
+		else:
+			k = Key(bucket, key)
+			if md5: md5 = (md5, binascii.b2a_base64(binascii.unhexlify(md5)).strip())
+			k.set_contents_from_filename(filename, headers=dict(headers),
+					policy='public-read', md5=md5)
+		with self.lock:
+			self.bytes += size
+			if not part:
+				self.files += 1
+				self.etags[key] = k.etag.strip('"')
+		self.report()
+
+	def report(self, final=False):
+		""" Print aggregate throughput """
+		now = time.time()
+		if not final and now - self.reported < 1: return
+		self.reported = now
+		elapsed = max(now - self.started, 0.001)
+		with print_lock:
+			sys.stdout.write('\r%s/%s files, %.1f MB, %.1f files/s, %.2f MB/s%s' % (
+				self.files, self.total, self.bytes / 1048576.0,
+				self.files / elapsed, self.bytes / 1048576.0 / elapsed,
+				final and '\n' or ''))
+			sys.stdout.flush()
+
+	def delete(self, keys):
+		""" Delete keys from the bucket """
+		failed = parallel(lambda key: self.bucket().delete_key(key), keys, self.jobs)
+		if failed: error('failed to delete %s' % ', '.join(sorted(k for k, e in failed)))
 
 def s3bucket(ec2, env, source):
-	""" Copy contents of static directory to s3 bucket """
+	"""
+	Copy contents of static directory to s3 bucket
+
+	Unless the bucket config sets sync to false only new and changed files
+	are sent, and files removed locally are deleted from the bucket when it
+	sets delete.  Returns the uploaded and deleted keys per machine name.
+	"""
 	mime_types = {
 		"eot" : "application/vnd.ms-fontobject",
 		"ttf" : "font/truetype",
 		"otf" : "font/opentype",
 		"woff": "font/woff",
+		"css" : "text/css",
+		"js"  : "application/javascript",
+		"json": "application/json",
+		"svg" : "image/svg+xml",
 	}
-	s3b = boto.connect_s3(ec2.access_key,ec2.secret_key)
+	changed = {}
 	for machine in env:
 		if 's3bucket' in machine.keys():
 			print 'Copying static media for %s' % machine['name']
 			s3bucket = machine['s3bucket']
+			s3b = connect_s3(ec2, s3bucket)
 
 			# Get the expires
 			time_format = '%a, %d %b %Y %H:%M:%S'
@@ -296,224 +1480,543 @@ def s3bucket(ec2, env, source):
 			except:
 				error('Improperly formatted datetime: %s' % expires)
 
-			# Get or create bucket using the name
+			# Get or create bucket using the name, public for all items
 			name    = s3bucket.get('name','s3%s'%machine['name'])
 			try: b = s3b.get_bucket(name)
-			except: b = s3b.create_bucket(name)
-			
-			# Set ACL Public for all items in the bucket
-			b.set_acl('public-read')
-
-			k = Key(b)
-			static_dir = os.path.join(source,'project','static')
-			for root, dirs, files in os.walk(static_dir):
-				if '.svn' in dirs: dirs.remove('.svn')
-				key_root = root.split('static')[1]
-
-				for file in files:
-					filename = os.path.join(root,file)
-
-					# Set the headers
-					headers = {'Expires':expires}
-					if '.gz' in file:
-						headers.update({'Content-Encoding':'gzip'})
-
-					if os.path.isfile(filename):
-						# Set the mime-type
-						ext = file.split('.')[-1]
-						if ext in mime_types.keys():
-							k.content_type = mime_types[ext]
-
-						# Send the file
-						k.key = os.path.join(key_root,file)
-						print '\nTransfering %s' % filename
-						k.set_contents_from_filename(filename, headers=headers, cb=s3_percent_cb, num_cb=10)
-			print '\nTransfer complete'
-
-	invalidate_cache(ec2, env, source)
-
-def invalidate_cache(ec2, env, source):
-	""" Invalidate CloudFront cache for each machine with a Cloudfront Distribution ID"""
+			except:
+				b = s3b.create_bucket(name)
+				b.set_acl('public-read')
+
+			cache_control = s3bucket.get('cache_control', 'public, max-age=%d' %
+					max(0, calendar.timegm(time.strptime(expires, time_format)) - time.time()))
+
+			# Compress text assets
+			files = list(static_files(source))
+			if s3bucket.get('gzip', False):
+				hashes_file = os.path.join(cache_dir('gzip'), '%s.json' % name)
+				hashes = {}
+				if os.path.exists(hashes_file):
+					hashes = json.load(open(hashes_file))
+				with trace.span('gzip', bucket=name):
+					files = precompress(files, s3bucket.get('gzip_types', gzip_types), hashes)
+				write_atomic(hashes_file, json.dumps(hashes))
+			else: files = [(key, filename, False) for key, filename in files]
+			compressed = set(key for key, filename, gz in files if gz)
+			files = [(key, filename) for key, filename, gz in files]
+
+			# Work out what needs to be sent
+			manifest_file = os.path.join(cache_dir('s3'), '%s.json' % name)
+			manifest = {}
+			if os.path.exists(manifest_file):
+				manifest = json.load(open(manifest_file))
+			sync = s3bucket.get('sync', True)
+			if sync:
+				with trace.span('s3 diff', bucket=name):
+					uploads, deletes = s3diff(b, files, manifest, s3bucket.get('delete', False))
+			else: uploads, deletes = files, []
+			print '%s to upload, %s unchanged, %s to delete' % (
+					len(uploads), len(files) - len(uploads), len(deletes))
+
+			transfers = []
+			for key, filename in uploads:
+				# Set the headers
+				headers = {'Expires':expires, 'Cache-Control':cache_control}
+				if key in compressed or '.gz' in os.path.basename(key):
+					headers.update({'Content-Encoding':'gzip'})
+
+				# Set the mime-type
+				ext = key.split('.')[-1].lower()
+				if ext in mime_types.keys():
+					headers['Content-Type'] = mime_types[ext]
+				elif mimetypes.guess_type(key)[0]:
+					headers['Content-Type'] = mimetypes.guess_type(key)[0]
+				# Only s3diff() refreshes the manifest, so its md5s are stale otherwise
+				transfers.append((key, filename, headers, sync and manifest[key]['md5'] or None))
+
+			# Send the files
+			transfer = S3Transfer(lambda: connect_s3(ec2, s3bucket), name,
+					jobs=s3bucket.get('concurrency', 8),
+					threshold=s3bucket.get('multipart_threshold', 16) << 20,
+					chunk=s3bucket.get('multipart_chunk', 8) << 20)
+			with trace.span('s3 upload', bucket=name, files=len(transfers)):
+				etags = transfer.upload(transfers)
+			for key, etag in etags.iteritems():
+				if sync: manifest[key]['etag'] = etag
+			with trace.span('s3 delete', bucket=name, files=len(deletes)):
+				transfer.delete(deletes)
+			write_atomic(manifest_file, json.dumps(manifest))
+			changed[machine['name']] = [k for k, f in uploads] + deletes
+			print 'Transfer complete'
+
+	invalidate_cache(ec2, env, source, changed)
+	return changed
+
+def collapse_paths(paths, threshold=10):
+	"""
+	Replace the paths in any directory holding threshold or more of them,
+	counting collapsed subdirectories as one, with a wildcard for it.
+	Directories are collapsed deepest first.
+	"""
+	paths = set(p.startswith('/') and p or '/' + p for p in paths)
+	depth = lambda d: d.strip('/') and len(d.strip('/').split('/')) or 0
+	while threshold:
+		dirs = {}
+		for p in paths:
+			if p == '/*': continue
+			d = posixpath.dirname(p.endswith('/*') and p[:-2] or p)
+			dirs.setdefault(d, []).append(p)
+		full = [d for d in dirs if len(dirs[d]) >= threshold]
+		if not full: break
+		deepest = max(depth(d) for d in full)
+		for d in full:
+			if depth(d) == deepest:
+				paths.difference_update(dirs[d])
+				paths.add(d.rstrip('/') + '/*')
+	return sorted(paths)
+
+def invalidation_batches(paths, size=1000, wildcards=15):
+	""" Split paths into batches within CloudFront's per request limits """
+	batches, batch, wild = [], [], 0
+	for p in paths:
+		if len(batch) == size or (p.endswith('*') and wild == wildcards):
+			batches.append(batch)
+			batch, wild = [], 0
+		batch.append(p)
+		wild += p.endswith('*')
+	return batch and batches + [batch] or batches
+
+def invalidations_in_progress(cfc, distribution):
+	""" Return the number of invalidations in progress on a distribution """
+	response = cfc.make_request('GET', '/%s/distribution/%s/invalidation' %
+			(cfc.Version, distribution))
+	body = response.read()
+	if response.status != 200:
+		raise CloudFrontServerError(response.status, response.reason, body)
+	return body.count('<Status>InProgress</Status>')
+
+def invalidate_cache(ec2, env, source, changed=None):
+	"""
+	Invalidate CloudFront cache for each machine with a Cloudfront Distribution ID
+
+	Only the keys in changed, as returned by s3bucket(), are invalidated
+	when it is given, otherwise every static file is.  The cloudfront config
+	is either the distribution ID or a dict with its id, the wildcard
+	threshold for collapse_paths() (0 to never collapse) and whether to wait
+	for the invalidations to complete.
+	"""
 	# NOTE: Creating distributions is not yet supported, only cache invalidation
 	cfc = CloudFrontConnection(ec2.access_key,ec2.secret_key)
 	for machine in env:
 		if 'cloudfront' in machine.keys():
-			print 'Invalidating cache for %s' % machine['name']
 			cloudfront = machine['cloudfront'] # Cloudfront Distribution ID
+			if not isinstance(cloudfront, dict): cloudfront = {'id':cloudfront}
+
+			if changed is None:
+				media_files = [key for key, filename in static_files(source)]
+			else: media_files = changed.get(machine['name'], [])
+			if not media_files:
+				print 'Nothing to invalidate for %s' % machine['name']
+				continue
+			paths = collapse_paths(media_files, cloudfront.get('wildcard', 10))
+			batches = invalidation_batches(paths)
+			print 'Invalidating %s path%s for %s in %s request%s' % (len(paths),
+					len(paths)>1 and 's' or '', machine['name'],
+					len(batches), len(batches)>1 and 's' or '')
+
+			# Wait for earlier invalidations when CloudFront has too many
+			delay = 5
+			while batches:
+				try:
+					with trace.span('invalidate', machine=machine['name'], paths=len(batches[0])):
+						cfc.create_invalidation_request(cloudfront['id'], batches[0])
+					batches.pop(0)
+				except CloudFrontServerError, e:
+					if 'TooManyInvalidationsInProgress' not in e.body: raise
+					print 'Too many invalidations in progress, retrying in %s seconds' % delay
+					time.sleep(delay)
+					delay = min(delay * 2, 60)
+
+			if cloudfront.get('wait', False):
+				with trace.span('invalidate wait', machine=machine['name']):
+					while invalidations_in_progress(cfc, cloudfront['id']):
+						print 'Waiting on invalidations for %s' % machine['name']
+						time.sleep(30)
+				print 'Invalidation complete for %s' % machine['name']
+
+class Progress(object):
+	"""
+	Output stream that keeps the last lines written to it, and status
+	changes, so the build server can stream them to its clients as they
+	arrive.
+	"""
+	def __init__(self, stream, size=1000):
+		self.stream  = stream
+		self.events  = collections.deque(maxlen=size) # (id, event, data)
+		self.count   = 0
+		self.partial = ''
+		self.changed = threading.Condition()
+
+	def write(self, data):
+		self.stream.write(data)
+		with self.changed:
+			lines = re.split('[\r\n]', self.partial + data)
+			self.partial = lines.pop()
+			for line in lines: self.publish('message', re.sub('\033\[\d+m', '', line))
+
+	def flush(self):
+		self.stream.flush()
+
+	def publish(self, event, data):
+		""" Add an event and wake up everyone waiting on one """
+		with self.changed:
+			self.count += 1
+			self.events.append((self.count, event, data))
+			self.changed.notify_all()
+
+	def since(self, n, timeout=15):
+		""" Return the events after id n, waiting up to timeout seconds for one """
+		with self.changed:
+			if self.count <= n and timeout: self.changed.wait(timeout)
+			return [e for e in self.events if e[0] > n]
+
+
+class Job(object):
+	""" A build server action queued against an environment """
+	def __init__(self, id, env, action):
+		self.id       = id
+		self.env      = env
+		self.action   = action
+		self.state    = 'queued'
+		self.error    = None
+		self.queued   = time.time()
+		self.started  = None
+		self.finished = None
+		self.profile  = None
+
+	def as_dict(self):
+		return {'id':self.id, 'env':self.env, 'action':self.action,
+			'state':self.state, 'error':self.error, 'queued':self.queued,
+			'started':self.started, 'finished':self.finished, 'profile':self.profile,
+			'duration':self.started and (self.finished or time.time()) - self.started}
+
+class JobQueue(object):
+	"""
+	Run jobs on a pool of workers threads.
 
-			media_files = []
-			static_dir = os.path.join(source,'project','static')
-			for root, dirs, files in os.walk(static_dir):
-				if '.svn' in dirs: dirs.remove('.svn')
-				key_root = root.split('static')[1]
-
-				for file in files:
-					filename = os.path.join(root,file)
-					if os.path.isfile(filename):
-						media_files.append(os.path.join(key_root,file))
-
-			cfc.create_invalidation_request(cloudfront, media_files)
-
-class Background(threading.Thread):
-	def __init__(self, fn, finish=None, args=None, kwargs=None):
-		self.fn = fn
-		self.finish = finish
-		self.args = args or []
-		self.kwargs = kwargs or {}
-		super(Background, self).__init__()
-	def run(self):
-		self.fn(*self.args, **self.kwargs)
-		if self.finish: self.finish()
+	Jobs for one environment run one at a time in the order they were
+	queued, while jobs for other environments run alongside them.  notify is
+	called with a job whenever it changes state, and the last keep finished
+	jobs are remembered.
+	"""
+	def __init__(self, run, notify, workers=2, keep=100):
+		self.run     = run
+		self.notify  = notify
+		self.keep    = keep
+		self.jobs    = [] # oldest first
+		self.busy    = set()
+		self.count   = 0
+		self.changed = threading.Condition()
+		for n in range(workers):
+			worker = threading.Thread(target=self.work)
+			worker.daemon = True
+			worker.start()
+
+	def submit(self, env, action):
+		""" Queue action against env and return its job """
+		with self.changed:
+			self.count += 1
+			job = Job(self.count, env, action)
+			self.jobs.append(job)
+			finished = [j for j in self.jobs if j.finished]
+			for j in finished[:max(0, len(finished) - self.keep)]:
+				self.jobs.remove(j)
+			self.changed.notify_all()
+		self.notify(job)
+		return job
+
+	def next(self):
+		""" Wait for a queued job whose environment is free and start it """
+		with self.changed:
+			while 1:
+				for job in self.jobs:
+					if job.state == 'queued' and job.env not in self.busy:
+						job.state, job.started = 'running', time.time()
+						self.busy.add(job.env)
+						return job
+				self.changed.wait()
+
+	def work(self):
+		while 1:
+			job = self.next()
+			self.notify(job)
+			context.run = job.id
+			try:
+				self.run(job)
+				job.state = 'done'
+			except (Exception, SystemExit), e:
+				job.state, job.error = 'failed', re.sub('\033\[\d+m', '', str(e)).strip()
+			spans = trace.pop(job.id)
+			job.profile = profile(spans)
+			print 'Job %s %s' % (job.id, job.state)
+			print_profile(spans)
+			with self.changed:
+				job.finished = time.time()
+				self.busy.discard(job.env)
+				self.changed.notify_all()
+			self.notify(job)
+
+	def list(self):
+		""" Return every remembered job, newest first """
+		with self.changed:
+			return [job.as_dict() for job in reversed(self.jobs)]
+
+class BuildHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	""" Build server that handles each request on its own thread """
+	daemon_threads = True
+
+	def __init__(self, address, handler, settings, progress, workers=2):
+		BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+		self.settings = settings
+		self.progress = progress
+		self.rendered = (None, '')
+		self.queue    = JobQueue(self.run, self.notify, workers)
+
+	def notify(self, job):
+		self.progress.publish('status', json.dumps(job.as_dict()))
+
+	def run(self, job):
+		""" Check out the source and carry out a job's action """
+		env = self.settings['deploy'][job.env]
+		print 'Job %s: %s %s' % (job.id, job.action, job.env)
+		source = prepare(self.settings, dir=self.dir, tag=self.tag) #TODO: Make tag choosable?
+		try:
+			if job.action == 'Build':
+				build(self.ec2, env, source, jobs=self.jobs, script=self.script)
+			if job.action in ('Build', 'Update'):
+				update(self.ec2, env, source, jobs=self.jobs,
+						artifact=self.artifact, rolling=self.rolling, script=self.script)
+			elif job.action == 'Sync Static':
+				s3bucket(self.ec2, env, source)
+		finally:
+			discard(source)
+			self.store.save()
 
 class BuildServer(BaseHTTPServer.BaseHTTPRequestHandler):
 	html = '''<!doctype html><html>
 	<head><title>Build Server %(version)s</title>
 		<style type="text/css">
-		.waiting {color:#0f0;}
-		.building {color:#f00;}
-		.updating {color:#00f;}
-		.syncing {color:#00f;}
-		.footer {font:x-small monospace; white-space:pre-wrap;}
+		.done {color:#0f0;}
+		.failed {color:#f00;}
+		.running {color:#00f;}
+		.queued {color:#999;}
+		.log {font:x-small monospace; white-space:pre-wrap;}
 		</style>
 		<script type="text/javascript">
 		window.onload = function(){
-			var timer = document.getElementById('time');
-			var time = 10;
-			setInterval(function(){
-				timer.innerText = --time;
-				if (time < 1){
-					window.location = window.location;
-					time = 0;
-				}
-			}, 1000);
+			var log = document.getElementById('log');
+			var events = new EventSource('/events?since=%(since)s');
+			events.onmessage = function(e){
+				log.appendChild(document.createTextNode(e.data + '\\n'));
+				window.scrollTo(0, document.body.scrollHeight);
+			};
+			events.addEventListener('status', function(e){
+				window.location = window.location;
+			});
 		}
 		</script>
 	</head>
 	<body>
 		<form method="POST">
-		<div>Status: <span class="%(status)s">%(status)s</span></div>
 		%(actions)s
-		<div>Refreshing in <span id="time">10</span> seconds</div>
 		</form>
+		<ul>%(jobs)s</ul>
 		<ul>%(servers)s</ul>
-		%(fortune)s
+		<hr /><div id="log" class="log">%(log)s</div>
 	</body>
 	</html>
 	'''
 	actions = '''<input name="action" type="submit" value="Build" />
 	<input name="action" type="submit" value="Update" />
 	<input name="action" type="submit" value="Sync Static" />'''
-	def do_GET(self):
-		if self.path != '/':
-			self.send_response(204)
-			return
-		self.send_response(200)
-		self.send_header('Content-Type', 'text/html')
-		self.end_headers()
+	def servers(self):
+		""" Render the server list, cached until the settings or inventory change """
+		inventory = get_inventory(self.server.ec2)
+		try: snapshot = inventory.load()['time']
+		except Exception, e: # List the servers without states while AWS is unreachable
+			warning('could not load the inventory: %s' % e)
+			inventory = snapshot = None
+		signature = json.dumps([self.server.settings['deploy'], snapshot], sort_keys=True)
+		if self.server.rendered[0] == signature: return self.server.rendered[1]
 		servers = ''
-		kwargs = {'actions':'', 'status':self.server.status, 'version':VERSION}
 		for e in self.server.settings['deploy']:
 			servers += '<li>%s<ul>'%e
 			for m in self.server.settings['deploy'][e]:
 				h = m.get('host', '')
-				servers += ('<li><a href="%s">%s</a></li>' % (
+				states = [i['state'] for i in inventory and h and inventory.lookup('dns', h) or []]
+				servers += ('<li><a href="%s">%s</a> %s</li>' % (
 					h and 'http://%s%s'%(h, m.get('url', '')) or '',
-					m.get('name', 'Unnamed Machine')))
+					m.get('name', 'Unnamed Machine'), ', '.join(states)))
 			servers += '</ul></li>'
-		kwargs['servers'] = servers
-		try:
-			kwargs['fortune'] = '<hr /><div class="footer">%s</div>' % subprocess.check_output('fortune')
-		except: kwargs['fortune'] = ''
-		if self.server.status == 'waiting':
-			kwargs['actions'] = self.actions
+		if inventory: self.server.rendered = (signature, servers)
+		return servers
+	def jobs(self):
+		""" Render the ten most recent jobs """
+		return ''.join('<li>#%(id)s %(action)s %(env)s <span class="%(state)s">%(state)s</span>'
+			' %(time)s %(error)s</li>' % dict(job, time=job['duration'] is not None
+				and '%.0fs' % job['duration'] or '', error=cgi.escape(job['error'] or ''))
+			for job in self.server.queue.list()[:10])
+	def do_GET(self):
+		url = urlparse.urlparse(self.path)
+		if url.path == '/events': return self.events(url)
+		if url.path == '/jobs':
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/json')
+			self.end_headers()
+			self.wfile.write(json.dumps(self.server.queue.list(), indent=4))
+			return
+		if url.path != '/':
+			self.send_response(204)
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/html')
+		self.end_headers()
+		events = self.server.progress.since(0, 0)
+		kwargs = {'actions':self.actions, 'version':VERSION, 'jobs':self.jobs(),
+			'servers':self.servers(), 'since':events and events[-1][0] or 0,
+			'log':cgi.escape('\n'.join([d for n, e, d in events if e == 'message'][-100:]))}
 		self.wfile.write(self.html % kwargs)
+	def events(self, url):
+		""" Stream progress to the page as Server-Sent Events """
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/event-stream')
+		self.send_header('Cache-Control', 'no-cache')
+		self.end_headers()
+		n = int(self.headers.get('Last-Event-ID') or
+				urlparse.parse_qs(url.query).get('since', [0])[0])
+		try:
+			while 1:
+				events = self.server.progress.since(n)
+				if not events: self.wfile.write(': keepalive\n\n')
+				for n, event, data in events:
+					self.wfile.write('id: %s\nevent: %s\ndata: %s\n\n' % (n, event, data))
+				self.wfile.flush()
+		except socket.error: return
 	def do_POST(self):
-		self.send_response(301)
+		post = urlparse.parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+		action, env = post.get('action', [''])[0], post.get('env', [''])[0]
+		if action not in ('Build', 'Update', 'Sync Static') or env not in self.server.settings['deploy']:
+			self.send_error(400, 'unknown action or env')
+			return
+		self.server.queue.submit(env, action)
+		self.send_response(303)
 		self.send_header('Location', '/')
 		self.end_headers()
-		if self.server.status == 'waiting':
-			post = urlparse.parse_qs(self.rfile.readline())
-			action = post['action'][0]
-			env = self.server.settings['deploy'][post['env'][0]]
-			tag = self.server.tag #TODO: Make choosable?
-			source = prepare(self.server.settings, dir=self.server.dir, tag=tag)
-			updater = Background(update, self.server.reset,
-					[self.server.ec2, env, source])
-			if action == 'Build':
-				self.server.status = 'building'
-				Background(build, updater.start,
-						[self.server.ec2, env, source]).start()
-			elif action == 'Update':
-				self.server.status = 'updating'
-				updater.start()
-			elif action == 'Sync Static':
-				self.server.status = 'syncing'
-				Background(s3bucket, self.server.reset,
-						[self.server.ec2, env, source]).start()
-
-def get_map(ec2):
+
+class Inventory(object):
+	"""
+	Snapshot of the key pairs, security groups, load balancers, buckets and
+	instances of an account.
+
+	The resource types are fetched concurrently and the snapshot is kept in
+	~/.builder for ttl seconds, so repeated lookups do not hit the API.
+	Instances can be looked up by dns name, instance id, Name tag and AMI.
+	"""
+	def __init__(self, ec2, ttl=300):
+		self.ec2   = ec2
+		self.ttl   = ttl
+		self.file  = os.path.join(cache_dir(), 'inventory.%s.json' %
+				hashlib.md5(ec2.access_key).hexdigest())
+		self.lock  = threading.Lock()
+		self.data  = None
+		self.index = None
+
+	def fetch(self):
+		""" Fetch every resource type concurrently """
+		ec2  = self.ec2
+		data = {'asgs':{}, 'time':time.time()}
+		def keys():
+			data['keys'] = dict((k.name, k.fingerprint) for k in ec2.get_all_key_pairs())
+		def security_groups():
+			data['security_groups'] = {}
+			for s in ec2.get_all_security_groups():
+				rules = {}
+				for r in s.rules:
+					g = str(r.grants)
+					if g not in rules: rules[g] = []
+					rules[g].append('%s:[%s%s]' % (r.ip_protocol, r.from_port,
+						r.to_port != r.from_port and '-'+r.to_port or ''))
+				data['security_groups'][s.name] = rules
+		def elbs():
+			elb = boto.connect_elb(ec2.access_key, ec2.secret_key)
+			data['elbs'] = dict((lb.name, {'dns_name':lb.dns_name,
+				'instances':[i.id for i in lb.instances]})
+				for lb in elb.get_all_load_balancers())
+		def buckets():
+			s3b = boto.connect_s3(ec2.access_key,ec2.secret_key)
+			data['buckets'] = sorted(b.name for b in s3b.get_all_buckets())
+		def instances():
+			data['instances'] = [{'id':i.id, 'image_id':i.image_id,
+				'state':i.state, 'dns_name':i.public_dns_name, 'reason':i.reason,
+				'groups':[g.id for g in r.groups], 'name':i.tags.get('Name')}
+				for r in ec2.get_all_instances() for i in r.instances]
+		# Need to map out 'asg'
+		# * Launch Configurations
+		# * AutoScaling Groups
+		# * AutoScaling Triggers and Instances
+		failed = parallel(lambda fn: fn(),
+				[keys, security_groups, elbs, buckets, instances], 5)
+		if failed: raise failed[0][1]
+		return data
+
+	def load(self, refresh=False):
+		""" Return the snapshot, fetching it if it is missing, stale or refresh is set """
+		with self.lock:
+			if not refresh and not self.data and os.path.exists(self.file):
+				self.data = json.load(open(self.file))
+			if refresh or not self.data or time.time() - self.data['time'] > self.ttl:
+				self.data = self.fetch()
+				write_atomic(self.file, json.dumps(self.data))
+				self.index = None
+			if not self.index:
+				self.index = {'dns':{}, 'id':{}, 'name':{}, 'ami':{}}
+				for i in self.data['instances']:
+					for field, value in (('dns', i['dns_name']), ('id', i['id']),
+							('name', i['name']), ('ami', i['image_id'])):
+						if value: self.index[field].setdefault(value, []).append(i)
+			return self.data
+
+	def lookup(self, field, value):
+		""" Return the instances whose dns, id, name or ami is value """
+		self.load()
+		return self.index[field].get(value, [])
+
+	def invalidate(self):
+		""" Forget the snapshot so the next lookup fetches a new one """
+		with self.lock:
+			self.data = self.index = None
+			if os.path.exists(self.file): os.remove(self.file)
+
+inventories, inventories_lock = {}, threading.Lock()
+
+def get_inventory(ec2):
+	""" Return the shared Inventory for an ec2 connection's account """
+	with inventories_lock:
+		if ec2.access_key not in inventories:
+			inventories[ec2.access_key] = Inventory(ec2)
+		return inventories[ec2.access_key]
+
+def get_map(ec2, refresh=False):
 	""" Map the data from each available connection """
-	# Get extra connections
-	elb = boto.connect_elb(ec2.access_key, ec2.secret_key)
-	asg = boto.connect_autoscale(ec2.access_key, ec2.secret_key)
-	s3b = boto.connect_s3(ec2.access_key,ec2.secret_key)
+	data = get_inventory(ec2).load(refresh)
 
-	# EC2 Keypairs
-	keys = {}
-	for k in ec2.get_all_key_pairs():
-		keys[k.name] = k.fingerprint
-	
-	# EC2 Security Groups
-	security_groups = {}
-	for s in ec2.get_all_security_groups():
-		rules = {}
-		for r in s.rules:
-			g = str(r.grants)
-			if g not in rules: rules[g] = []
-			rules[g].append('%s:[%s%s]' % (r.ip_protocol, r.from_port,
-				r.to_port != r.from_port and '-'+r.to_port or ''))
-		security_groups[s.name] = rules
-	
-	# Elastic Load Balancers
-	elbs = {}
-	for lb in elb.get_all_load_balancers():
-		info = {}
-		info['instances'] = lb.instances
-		info['dns_name']  = lb.dns_name
-		elbs[lb.name] = info
-
-	# Need to map out 'asg'
-	# * Launch Configurations
-	# * AutoScaling Groups
-	# * AutoScaling Triggers and Instances
-
-	# S3 Buckets
-	buckets = {}
-	for b in s3b.get_all_buckets():
-		buckets[b.name] = b
-
-	# EC2 Instances
+	# EC2 Instances by AMI and state
 	instances = {}
-	for r in ec2.get_all_instances():
-		for i in r.instances:
-			if i.image_id not in instances:
-				instances[i.image_id] = {}
-			if i.state not in instances[i.image_id]:
-				instances[i.image_id][i.state] = []
-			instances[i.image_id][i.state].append(i)
-	
-	data = {
-		'asgs': {},
-		'elbs': elbs,
-		'instances': instances,
-		'keys': keys,
-		's3bs': buckets,
-		'security_groups': security_groups,
-	}
-	return data
+	for i in data['instances']:
+		instances.setdefault(i['image_id'], {}).setdefault(i['state'], []).append(i)
+	return dict(data, instances=instances)
 
-def print_map(ec2):
-	data = get_map(ec2)
+def print_map(ec2, refresh=False):
+	data = get_map(ec2, refresh)
 	keys = data.get('keys')
 	if keys:
 		print 'Key Pairs:'
@@ -543,20 +2046,83 @@ def print_map(ec2):
 	if buckets:
 		print
 		print 'Buckets:'
-		for k, v in buckets.iteritems():
-			print '\t', k, '\t', v
+		for b in buckets:
+			print '\t', b
 
 	instances = data.get('instances')
 	if instances:
 		print
 		print 'Instances:'
 		for k, v in instances.iteritems():
-			print '\tAMI: %s (%s)' % (k, 'running' in v and 
-					', '.join([g.groupName for g in v['running'][0].groups])
+			print '\tAMI: %s (%s)' % (k, 'running' in v and
+					', '.join(v['running'][0]['groups'])
 					or 'no images running')
 			for k2, v2 in v.iteritems():
 				print '\t\t%s:' % k2, ', '.join([k2=='running' and
-					i.public_dns_name or i.reason for i in v2])
+					i['dns_name'] or i['reason'] for i in v2])
+
+def print_images(ec2):
+	""" Print the cached base and role images, newest first """
+	for title, filename in (('Base Images', 'bases.json'), ('Role Images', 'images.json')):
+		known = ImageBaker(ec2, filename=filename).known
+		if not known: continue
+		print '%s:' % title
+		for fingerprint, entry in sorted(known.iteritems(), key=lambda (f, e): -e['created']):
+			print '\t%s\t%s\t%s\t%s' % (entry['image'], fingerprint[:8], entry['created'] and
+					time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created'])) or 'unknown',
+					entry['name'] or '')
+
+class Settings(object):
+	"""
+	The settings in a conf file, with what builder learns about each machine
+	(its host, image and load balancer host) kept in a separate state file
+	next to it, so the conf file is never rewritten.
+
+	The state is laid over the settings when they are loaded.  save() writes
+	it atomically, only when it changed since it was last written, and
+	behind a lock so the build server's workers can save at any time.
+	"""
+	def __init__(self, conf):
+		self.conf     = conf
+		self.file     = '%s.state.json' % os.path.splitext(conf)[0]
+		self.lock     = threading.Lock()
+		self.settings = json.load(open(conf))
+		state = os.path.exists(self.file) and json.load(open(self.file)) or {}
+		for env, name, n, machine in self.machines():
+			entries = state.get(env, {}).get(name, [])
+			if n >= len(entries): continue
+			for field in ('host', 'image'):
+				if field in entries[n]: machine[field] = entries[n][field]
+			if 'load_balancer_host' in entries[n] and 'load_balancer' in machine:
+				machine['load_balancer']['host'] = entries[n]['load_balancer_host']
+		self.saved = self.dumps()
+
+	def machines(self):
+		""" Yield env, name, n, machine for the nth machine of each name in each env """
+		for env, machines in self.settings.get('deploy', {}).iteritems():
+			seen = collections.defaultdict(int)
+			for machine in isinstance(machines, dict) and [machines] or machines:
+				name = machine.get('name')
+				yield env, name, seen[name], machine
+				seen[name] += 1
+
+	def dumps(self):
+		state = {}
+		for env, name, n, machine in self.machines():
+			entry = dict((field, machine[field]) for field in ('host', 'image') if field in machine)
+			if machine.get('load_balancer', {}).get('host'):
+				entry['load_balancer_host'] = machine['load_balancer']['host']
+			state.setdefault(env, {}).setdefault(name, []).append(entry)
+		return json.dumps(state, sort_keys=True, indent=4)
+
+	def save(self):
+		""" Write the machine state if it changed, returning whether it did """
+		with self.lock:
+			data = self.dumps()
+			if data == self.saved: return False
+			write_atomic(self.file, data)
+			self.saved = data
+			return True
 
 def main(options):
 	# Get or create the conf file and set the settings
@@ -573,27 +2139,31 @@ def main(options):
 			while not defaults['secret']:
 				defaults['secret'] = raw_input('  Secret: ')
 			defaults['repo'] = raw_input('SVN Repo: ')
-			json.dump(defaults, open(conf, 'w'), sort_keys=True, indent=4)
+			write_atomic(conf, json.dumps(defaults, sort_keys=True, indent=4))
 			if 'EDITOR' in os.environ:
 				subprocess.call('%s %s' % (os.environ['EDITOR'], conf), shell=True)
 			if not defaults['repo']: warning('-t deployments will not work without a defined repo')
 		except:
 			error('conf file creation interrupted')
-	settings = json.load(open(conf))
+	store = Settings(conf)
+	settings = store.settings
 
 	# Open EC2 connection
 	ec2 = boto.connect_ec2(settings['key'], settings['secret'])
 
 	# Create the server
 	if options.listen:
-		def reset(self):
-			self.status = 'waiting'
-		server = BaseHTTPServer.HTTPServer(('', options.listen), BuildServer)
+		trace.enabled = True
+		sys.stdout = Progress(sys.stdout)
+		server = BuildHTTPServer(('', options.listen), BuildServer,
+				settings, sys.stdout, options.workers)
 		server.dir = options.dir
 		server.tag = options.tag
-		server.settings = settings
-		server.__class__.reset = reset #TODO: Use instance method?
-		server.reset()
+		server.jobs = options.jobs
+		server.artifact = options.artifact
+		server.rolling = options.rolling
+		server.script = options.script
+		server.store = store
 		server.ec2 = ec2
 		BuildServer.actions = '<select name="env">%s</select> ' % ''.join(
 				['<option value="%s">%s</option>' % (k,k)
@@ -608,7 +2178,12 @@ def main(options):
 		print 'Generated %s' % path(os.path.join(cwd, '%s.pem'%options.key))
 	
 	# Print a map of the data
-	if options.map: print_map(ec2)
+	if options.map: print_map(ec2, options.refresh)
+
+	# List or prune the cached images
+	if options.images: print_images(ec2)
+	if options.prune:
+		ImageBaker(ec2, filename='bases.json').prune(options.keep, options.max_age)
 	
 	# Set the source and env variables from the config
 	source = prepare(settings, dir=options.dir, tag=options.tag)
@@ -625,43 +2200,76 @@ def main(options):
 			code.interact()
 		return
 
+	# Bring existing machines up to date with their recipes
+	if options.provision:
+		if not env: error('deploy %s not found' % options.env)
+		with trace.span('provision'):
+			provision(env, source, jobs=options.jobs, script=options.script)
+
+	# Switch machines back to their previous release
+	if options.rollback:
+		if not env: error('deploy %s not found' % options.env)
+		with trace.span('rollback'):
+			rollback(env, source, jobs=options.jobs, script=options.script)
+
+	# Print what load balancing and autoscaling would change
+	if options.plan:
+		if not env: error('deploy %s not found' % options.env)
+		load_balance(ec2, env, dry_run=True)
+		autoscale(ec2, env, dry_run=True)
+
 	# Build or Update
 	if options.build or options.update:
 		if not env: error('deploy %s not found' % options.env)
 
 		# Build and update
+		bases = None
 		if options.build:
 			# Calculate number of new servers including autoscaling
 			n = 0
 			for machine in env: n += int(machine.get('autoscale',{}).get('min_size',1))
 			res = raw_input('Create %s server%s [y/N]? ' % (n, n>1 and 's' or ''))
 			if res and res.lower()[0] == 'y':
-				build(ec2, env, source)
+				with trace.span('build'):
+					bases = build(ec2, env, source, jobs=options.jobs, script=options.script)
 			else: print "Not building servers"
-		update(ec2, env, source)
-		json.dump(settings, open(conf, 'w'), sort_keys=True, indent=4)
+		try:
+			with trace.span('update'):
+				baker = update(ec2, env, source, jobs=options.jobs,
+						artifact=options.artifact, rolling=options.rolling, script=options.script)
+		finally:
+			# Base images are cached for later builds even if the update failed
+			if bases:
+				with trace.span('base image wait'): bases.wait()
+		store.save()
 	
 		# Load Balance Machines
-		load_balance(ec2, env)
-		json.dump(settings, open(conf, 'w'), sort_keys=True, indent=4)
+		with trace.span('load balance'): load_balance(ec2, env, jobs=options.jobs)
+		store.save()
 		
-		# Autoscale Machines
-		autoscale(ec2, env)
-		json.dump(settings, open(conf, 'w'), sort_keys=True, indent=4)
+		# Images are only recorded for later deploys once they are available
+		print 'Waiting on images'
+		with trace.span('image wait'): baker.wait()
+
+		# Autoscale Machines from their images
+		if any('autoscale' in machine for machine in env):
+			with trace.span('autoscale'): autoscale(ec2, env, jobs=options.jobs)
+			store.save()
 
 		# Clean up after autoscaling
 		for machine in env:
 			if 'autoscale' in machine and 'load_balancer' in machine:
 				get_instance(ec2, machine['host']).terminate()
 				machine['host'] = machine['load_balancer']['host']
-		json.dump(settings, open(conf, 'w'), sort_keys=True, indent=4)
+		get_inventory(ec2).invalidate()
+		store.save()
 
 	# Push static media to s3bucket
 	if options.bucket:
 		s3bucket(ec2,env,source)
 	
 	# Invalidate cloudfront cache
-	if options.cache:
+	if options.cache and not options.bucket:
 		invalidate_cache(ec2,env,source)
 
 if __name__ == '__main__':
@@ -669,12 +2277,30 @@ if __name__ == '__main__':
 	parser  = optparse.OptionParser(version = '%%prog %s' % VERSION)
 	parser.add_option('-m', '--map', action='store_true',
 			dest='map', help='prints out ec2 information',)
+	parser.add_option('-R', '--refresh', action='store_true',
+			help='refetch the ec2 information instead of using the cache',)
+	parser.add_option('-I', '--images', action='store_true',
+			help='prints out the cached base and role images',)
+	parser.add_option('-G', '--prune', action='store_true',
+			help='deregister cached base images beyond --keep or older than --max-age',)
+	parser.add_option('--keep', default=2, type='int',
+			help='keep the newest N base images of each machine [default: %default]',
+			metavar='N',)
+	parser.add_option('--max-age', default=30, type='int', dest='max_age',
+			help='keep base images for up to DAYS days [default: %default]',
+			metavar='DAYS',)
 	parser.add_option('-s', '--shell', action='store_true',
 			dest='shell', help='spawn a shell in the current virtualenv',)
 	parser.add_option('-b', '--build', action='store_true',
 			dest='build', help='create new ec2 instances',)
 	parser.add_option('-u', '--update', action='store_true',
 			dest='update', help='update existing ec2 instances',)
+	parser.add_option('-p', '--provision', action='store_true',
+			help='rerun changed init commands on existing ec2 instances',)
+	parser.add_option('--rollback', action='store_true',
+			help='switch existing ec2 instances back to their previous release',)
+	parser.add_option('--plan', action='store_true',
+			help='print the load balancer and autoscaling changes without making them',)
 	parser.add_option('-k', '--key', help='generate key KEY',
 			metavar='KEY',)
 	parser.add_option('-e', '--env', default='default',
@@ -691,6 +2317,22 @@ if __name__ == '__main__':
 	parser.add_option('-l', '--listen',
 			help='listen for requests on port PORT',
 			metavar='PORT', type='int')
+	parser.add_option('-j', '--jobs', default=4, type='int',
+			help='build or update up to N machines at once [default: %default]',
+			metavar='N',)
+	parser.add_option('-a', '--artifact', action='store_true',
+			help='push code as one tarball instead of rsync',)
+	parser.add_option('-r', '--rolling',
+			help='update SIZE machines, or a percentage, at a time',
+			metavar='SIZE',)
+	parser.add_option('-B', '--batch', action='store_true', dest='script',
+			help='run each machine\'s commands as one remote script',)
+	parser.add_option('-w', '--workers', default=2, type='int',
+			help='run up to N build server jobs at once [default: %default]',
+			metavar='N',)
+	parser.add_option('-P', '--profile',
+			help='append timings to FILE as JSON lines and print a summary',
+			metavar='FILE',)
 	parser.add_option('-S', '--s3bucket', action='store_true',
 			dest='bucket', help='upload static files to s3bucket',)
 	parser.add_option('-C', '--cache_invalidate', action='store_true',
@@ -699,4 +2341,9 @@ if __name__ == '__main__':
 			help='use template file FILE to build out new config',
 			metavar='FILE')
 	(kwargs, args) = parser.parse_args()
-	main(kwargs)
+	if kwargs.profile: trace.open(kwargs.profile)
+	try: main(kwargs)
+	finally:
+		connections.close()
+		discard()
+		if kwargs.profile: print_profile(trace.pop())
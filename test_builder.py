@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+Checks of builder against responses parsed by boto itself, so they break
+when builder reads an attribute boto does not set.
+
+	python test_builder.py
+"""
+import os, shutil, socket, sys, tempfile, unittest, xml.sax
+
+import boto, boto.exception, boto.handler
+from boto.resultset import ResultSet
+from boto.ec2.image import Image
+from boto.ec2.instance import Reservation
+from boto.ec2.autoscale import AutoScalingGroup, LaunchConfiguration, Trigger
+from boto.s3.key import Key
+import builder
+
+def parse(body, markers):
+	""" Return what boto makes of an API response body """
+	result = ResultSet(markers)
+	xml.sax.parseString(body, boto.handler.XmlHandler(result, None))
+	return result
+
+describe_instances = '''<?xml version="1.0" encoding="UTF-8"?>
+<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2010-08-31/">
+	<reservationSet><item>
+		<reservationId>r-1</reservationId>
+		<ownerId>1</ownerId>
+		<groupSet><item><groupId>default</groupId></item><item><groupId>web</groupId></item></groupSet>
+		<instancesSet><item>
+			<instanceId>i-1</instanceId>
+			<imageId>ami-1</imageId>
+			<instanceState><code>16</code><name>running</name></instanceState>
+			<dnsName>ec2-1.compute.example</dnsName>
+			<reason/>
+			<tagSet><item><key>Name</key><value>web</value></item></tagSet>
+		</item></instancesSet>
+	</item></reservationSet>
+</DescribeInstancesResponse>'''
+
+describe_launch_configurations = '''<DescribeLaunchConfigurationsResponse>
+	<DescribeLaunchConfigurationsResult><LaunchConfigurations><member>
+		<LaunchConfigurationName>launch_config_web</LaunchConfigurationName>
+		<ImageId>ami-1</ImageId>
+		<KeyName>key</KeyName>
+		<InstanceType>m1.small</InstanceType>
+		<SecurityGroups><member>default</member></SecurityGroups>
+	</member></LaunchConfigurations></DescribeLaunchConfigurationsResult>
+</DescribeLaunchConfigurationsResponse>'''
+
+describe_groups = '''<DescribeAutoScalingGroupsResponse>
+	<DescribeAutoScalingGroupsResult><AutoScalingGroups><member>
+		<AutoScalingGroupName>group_web</AutoScalingGroupName>
+		<LaunchConfigurationName>launch_config_web</LaunchConfigurationName>
+		<MinSize>1</MinSize>
+		<MaxSize>4</MaxSize>
+		<Cooldown>0</Cooldown>
+	</member></AutoScalingGroups></DescribeAutoScalingGroupsResult>
+</DescribeAutoScalingGroupsResponse>'''
+
+describe_triggers = '''<DescribeTriggersResponse>
+	<DescribeTriggersResult><Triggers><member>
+		<TriggerName>trigger_web</TriggerName>
+		<AutoScalingGroupName>group_web</AutoScalingGroupName>
+		<MeasureName>CPUUtilization</MeasureName>
+		<Statistic>Average</Statistic>
+		<Unit>Percent</Unit>
+		<Period>60</Period>
+		<BreachDuration>120</BreachDuration>
+		<LowerThreshold>15.0</LowerThreshold>
+		<UpperThreshold>30.0</UpperThreshold>
+		<LowerBreachScaleIncrement>-1</LowerBreachScaleIncrement>
+		<UpperBreachScaleIncrement>2</UpperBreachScaleIncrement>
+	</member></Triggers></DescribeTriggersResult>
+</DescribeTriggersResponse>'''
+
+describe_images = '''<DescribeImagesResponse>
+	<imagesSet><item>
+		<imageId>ami-2</imageId>
+		<imageState>available</imageState>
+	</item></imagesSet>
+</DescribeImagesResponse>'''
+
+class Empty(object):
+	def __getattr__(self, name): return lambda *args, **kwargs: []
+
+class InventoryTest(unittest.TestCase):
+	def setUp(self):
+		self.home, self.environ = tempfile.mkdtemp(), os.environ.get('HOME')
+		os.environ['HOME'] = self.home
+		self.connect_elb, self.connect_s3 = boto.connect_elb, boto.connect_s3
+		boto.connect_elb = boto.connect_s3 = lambda *args, **kwargs: Empty()
+
+	def tearDown(self):
+		boto.connect_elb, boto.connect_s3 = self.connect_elb, self.connect_s3
+		os.environ['HOME'] = self.environ
+		shutil.rmtree(self.home)
+
+	def test_instances(self):
+		ec2 = Empty()
+		ec2.access_key, ec2.secret_key = 'test', 'test'
+		ec2.get_all_instances = lambda *args, **kwargs: parse(describe_instances,
+			[('item', Reservation)])
+		inventory = builder.Inventory(ec2)
+		[info] = inventory.lookup('dns', 'ec2-1.compute.example')
+		self.assertEqual(info['id'], 'i-1')
+		self.assertEqual(info['state'], 'running')
+		self.assertEqual(info['groups'], ['default', 'web'])
+		self.assertEqual(info['name'], 'web')
+		self.assertEqual(builder.get_instance(ec2, 'ec2-1.compute.example').id, 'i-1')
+
+class AutoscaleTest(unittest.TestCase):
+	def setUp(self):
+		self.connect_autoscale, self.created = boto.connect_autoscale, []
+		asg = Empty()
+		asg.get_all_launch_configurations = lambda names=None: parse(describe_launch_configurations,
+			[('member', LaunchConfiguration)])
+		asg.get_all_groups = lambda names=None: parse(describe_groups, [('member', AutoScalingGroup)])
+		asg.get_all_triggers = lambda group: parse(describe_triggers, [('member', Trigger)])
+		for action in ('create_launch_configuration', 'create_auto_scaling_group', 'create_trigger'):
+			setattr(asg, action, lambda thing, action=action: self.created.append(action))
+		boto.connect_autoscale = lambda *args, **kwargs: asg
+
+	def tearDown(self):
+		boto.connect_autoscale = self.connect_autoscale
+
+	def test_unchanged(self):
+		ec2 = Empty()
+		ec2.access_key, ec2.secret_key = 'test', 'test'
+		env = [{'name':'web', 'image':'ami-1', 'key_pair':'key', 'size':'m1.small',
+			'groups':['default'], 'autoscale':{}}]
+		stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+		try: builder.autoscale(ec2, env)
+		finally: sys.stdout = stdout
+		self.assertEqual(self.created, [])
+
+class ImageBakerTest(unittest.TestCase):
+	def setUp(self):
+		self.home, self.environ = tempfile.mkdtemp(), os.environ.get('HOME')
+		os.environ['HOME'] = self.home
+
+	def tearDown(self):
+		os.environ['HOME'] = self.environ
+		shutil.rmtree(self.home)
+
+	def test_never_found(self):
+		def get_all_images(image_ids=None):
+			raise boto.exception.EC2ResponseError(400, 'Bad Request', '<Response><Errors><Error>'
+				'<Code>InvalidAMIID.NotFound</Code><Message>gone</Message></Error></Errors></Response>')
+		ec2 = Empty()
+		ec2.get_all_images, ec2.create_image = get_all_images, lambda *args, **kwargs: 'ami-2'
+		baker = builder.ImageBaker(ec2, delay=0, max_missing=3)
+		stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+		try:
+			baker.bake('f', Empty(), 'web')
+			self.assertRaises(SystemExit, baker.wait)
+		finally: sys.stdout = stdout
+		self.assertEqual(baker.failed, ['ami-2'])
+
+	def test_transient_errors(self):
+		answers = [socket.error('reset'), parse(describe_images, [('item', Image)])]
+		def get_all_images(image_ids=None):
+			answer = answers.pop(0)
+			if isinstance(answer, Exception): raise answer
+			return answer
+		ec2 = Empty()
+		ec2.get_all_images, ec2.create_image = get_all_images, lambda *args, **kwargs: 'ami-2'
+		baker = builder.ImageBaker(ec2, delay=0)
+		stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+		try:
+			baker.bake('f', Empty(), 'web')
+			baker.wait()
+		finally: sys.stdout = stdout
+		self.assertEqual(builder.ImageBaker(Empty()).known['f']['image'], 'ami-2')
+
+	def test_poller_dies(self):
+		ec2 = Empty()
+		ec2.get_all_images = lambda image_ids=None: parse(describe_images, [('item', Image)])
+		ec2.create_image = lambda *args, **kwargs: 'ami-2'
+		baker = builder.ImageBaker(ec2, delay=0)
+		def save(): raise IOError('disk full')
+		baker.save = save
+		stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+		try:
+			baker.bake('f', Empty(), 'web')
+			self.assertRaises(SystemExit, baker.wait)
+		finally: sys.stdout = stdout
+		self.assertEqual(str(baker.error), 'disk full')
+
+	def test_save_merges(self):
+		first, second = builder.ImageBaker(Empty()), builder.ImageBaker(Empty())
+		first.known['a'] = {'image':'ami-1', 'name':'web', 'created':0}
+		first.save()
+		second.known['b'] = {'image':'ami-2', 'name':'db', 'created':0}
+		second.save()
+		self.assertEqual(sorted(builder.ImageBaker(Empty()).known), ['a', 'b'])
+		stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+		try: second.prune(keep=0)
+		finally: sys.stdout = stdout
+		self.assertEqual(builder.ImageBaker(Empty()).known, {})
+
+class S3DiffTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.files = []
+		for name in ('same', 'grown', 'edited', 'multipart', 'new'):
+			filename = os.path.join(self.directory, name)
+			open(filename, 'w').write(name)
+			self.files.append((name, filename))
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def bucket(self, contents):
+		""" A bucket listing contents, a list of (key, etag, size), as boto parses it """
+		body = ''.join('<Contents><Key>%s</Key><ETag>&quot;%s&quot;</ETag><Size>%s</Size></Contents>' % c
+			for c in contents)
+		bucket = Empty()
+		bucket.list = lambda: parse('<ListBucketResult>%s</ListBucketResult>' % body, [('Contents', Key)])
+		return bucket
+
+	def test_diff(self):
+		md5 = lambda name: builder.md5file(os.path.join(self.directory, name))
+		multipart = os.stat(os.path.join(self.directory, 'multipart'))
+		manifest = {'multipart':{'mtime':multipart.st_mtime, 'size':multipart.st_size,
+				'md5':md5('multipart'), 'etag':'0123-2'},
+			'old':{'mtime':0, 'size':0, 'md5':'', 'etag':None}}
+		bucket = self.bucket([('same', md5('same'), 4), ('grown', md5('grown'), 3),
+			('edited', md5('same'), 6), ('multipart', '0123-2', 9), ('gone', md5('same'), 4)])
+		uploads, deletes = builder.s3diff(bucket, self.files, manifest, delete=True)
+		self.assertEqual(sorted(key for key, filename in uploads), ['edited', 'grown', 'new'])
+		self.assertEqual(deletes, ['gone'])
+		self.assertEqual(sorted(manifest), ['edited', 'grown', 'multipart', 'new', 'same'])
+		self.assertEqual(manifest['new']['md5'], md5('new'))
+		self.assertEqual(builder.s3diff(bucket, self.files, manifest)[1], [])
+
+class InvalidationTest(unittest.TestCase):
+	def test_collapse_deepest_first(self):
+		paths = ['a/b/%s' % n for n in range(3)] + ['a/%s' % n for n in range(2)]
+		self.assertEqual(builder.collapse_paths(paths, 3), ['/a/*'])
+
+	def test_collapse_below_threshold(self):
+		self.assertEqual(builder.collapse_paths(['a/1', '/a/2', 'b/1'], 3), ['/a/1', '/a/2', '/b/1'])
+
+	def test_collapse_to_root(self):
+		paths = ['/%s' % n for n in range(3)] + ['/a/%s' % n for n in range(3)]
+		self.assertEqual(builder.collapse_paths(paths, 3), ['/*'])
+
+	def test_batch_size(self):
+		batches = builder.invalidation_batches(['/%s' % n for n in range(2500)])
+		self.assertEqual([len(b) for b in batches], [1000, 1000, 500])
+
+	def test_batch_wildcards(self):
+		batches = builder.invalidation_batches(['/%s/*' % n for n in range(20)] + ['/x'])
+		self.assertEqual([len(b) for b in batches], [15, 6])
+		self.assertEqual(builder.invalidation_batches([]), [])
+
+if __name__ == '__main__':
+	unittest.main()